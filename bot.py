@@ -4,45 +4,78 @@ import aiohttp
 import datetime
 from discord.ext import commands, store_true
 from data.manager import DataManager
+from helpers import connection
+from collections import defaultdict
 import logging
+import logging.handlers
+import queue
+import random
+import json
 import sys
 import asyncpg
 import re
 
-ignore = [
-    "name",
-    "levelno",
-    "pathname",
-    "filename",
-    "module",
-    "exc_info",
-    "exc_text",
-    "stack_info",
-    "lineno",
-    "funcName",
-    "created",
-    "msecs",
-    "relativeCreated",
-    "thread",
-    "threadName",
-    "processName",
-    "process",
-]
+ignore = frozenset(
+    [
+        "name",
+        "levelno",
+        "pathname",
+        "filename",
+        "module",
+        "exc_info",
+        "exc_text",
+        "stack_info",
+        "lineno",
+        "funcName",
+        "created",
+        "msecs",
+        "relativeCreated",
+        "thread",
+        "threadName",
+        "processName",
+        "process",
+        # set when the record is passed through the logging queue
+        "message",
+    ]
+)
 
 
 class LoggingFormat(logging.Formatter):
+    def format(self, record):
+        return ", ".join(
+            f"{key}={value}"
+            for key, value in record.__dict__.items()
+            if key not in ignore
+        )
+
+
+class JSONFormat(logging.Formatter):
+    """Formats each record as a line of compact JSON"""
+
     def format(self, record):
         arguments = {
             key: value for key, value in record.__dict__.items() if key not in ignore
         }
-        return ", ".join(f"{key}={value}" for key, value in arguments.items())
+        return json.dumps(arguments, default=str, separators=(",", ":"))
+
 
+class SampleFilter(logging.Filter):
+    """Keeps only a fraction of the records of high volume messages"""
 
-async def prefix(bot, message):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.msg)
+        return rate is None or random.random() < rate
+
+
+def prefix(bot, message):
     if not message.guild:
         return commands.when_mentioned_or(bot.config.prefix)(bot, message)
     return commands.when_mentioned_or(
-        await bot.get_cog("Meta").get_prefix(message.channel.guild)
+        bot.get_cog("Meta").get_prefix(message.channel.guild)
     )(bot, message)
 
 
@@ -53,11 +86,18 @@ class Pokeland(store_true.StoreTrueMixin, commands.Bot):
         if not config:
             self.config = __import__("config").config
 
+        # records are written to stdout from a background thread so a slow
+        # stdout never blocks the event loop
         self.logger = logging.getLogger("discord")
         self.logger.setLevel(logging.INFO)
         handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(LoggingFormat())
-        self.logger.addHandler(handler)
+        handler.setFormatter(JSONFormat() if self.config.log_json else LoggingFormat())
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(SampleFilter(self.config.log_sample))
+        self.logger.addHandler(queue_handler)
+        self.log_listener = logging.handlers.QueueListener(log_queue, handler)
+        self.log_listener.start()
         self.data = DataManager(self)
 
         super().__init__(
@@ -76,6 +116,8 @@ class Pokeland(store_true.StoreTrueMixin, commands.Bot):
             ).predicate
         )
         self._uptime = discord.utils.utcnow()
+        # command name -> [invocations, database round trips]
+        self.round_trips = defaultdict(lambda: [0, 0])
 
         self.loop.run_until_complete(self.setup())
 
@@ -91,9 +133,30 @@ class Pokeland(store_true.StoreTrueMixin, commands.Bot):
         cls = cls or self.context
         return await super().get_context(message, cls=cls)
 
+    async def invoke(self, ctx):
+        token = connection.current_context.set(ctx)
+        try:
+            await super().invoke(ctx)
+        finally:
+            connection.current_context.reset(token)
+            self.record_round_trips(ctx)
+
+    def record_round_trips(self, ctx):
+        if ctx.command:
+            stats = self.round_trips[ctx.command.qualified_name]
+            stats[0] += 1
+            stats[1] += getattr(ctx, "round_trips", 0)
+
     async def setup(self):
         self.session = aiohttp.ClientSession()
-        self.connection = await asyncpg.create_pool(self.config.db_string)
+        pool = await asyncpg.create_pool(
+            self.config.db_string,
+            connection_class=connection.Connection,
+            init=connection.init,
+            **self.config.pool,
+        )
+        self.connection = connection.Pool(pool, self.config.acquire_timeout)
+        connection.queries.slow = self.config.slow_query_ms / 1000
         for extension in self.config.extensions:
             self.load_extension(extension)
 
@@ -116,5 +179,18 @@ class Pokeland(store_true.StoreTrueMixin, commands.Bot):
         super().run(self.config.token)
 
     async def close(self):
+        if spawning := self.get_cog("Spawning"):
+            # the database being down is a common reason to restart, shut down anyway
+            try:
+                await spawning.flush_xp()
+            except Exception as error:
+                self.logger.warning("XP Flush Failed", extra={"error": repr(error)})
+            try:
+                await spawning.snapshot_spawns()
+            except Exception as error:
+                self.logger.warning(
+                    "Spawn Snapshot Failed", extra={"error": repr(error)}
+                )
         await self.session.close()
         await super().close()
+        self.log_listener.stop()
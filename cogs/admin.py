@@ -2,6 +2,7 @@ import io
 import sys
 import copy
 import time
+import random
 import psutil
 import discord
 import pathlib
@@ -9,12 +10,15 @@ import textwrap
 import datetime
 import traceback
 import importlib
+import tracemalloc
+import types
 import dataclasses
 
-from typing import Union
+from typing import Union, Literal
+from collections import Counter
 from contextlib import redirect_stdout
 
-from helpers import misc, constants
+from helpers import misc, constants, models, connection
 from discord.ext import commands
 from prettytable import PrettyTable
 from jishaku.codeblocks import codeblock_converter
@@ -43,6 +47,56 @@ class BenchmarkTime:
         return f"Average: `{self.average*1000:,.2f}ms`\nHigh: `{self.high*1000:,.2f}ms`\nLow: `{self.low*1000:,.2f}ms`"
 
 
+@dataclasses.dataclass
+class LegacyDexEntry:
+    user_id: int
+    species_id: int
+    count: int
+    shinies: int
+
+
+class LegacyPokemon:
+    """The dict copying pokemon model, kept to benchmark against"""
+
+    def __init__(self, record, data=None):
+        self.record = dict(record)
+        self.data_manager = data
+
+    def __setattr__(self, attr, obj):
+        if hasattr(self, attr):
+            self.record[attr] = obj
+        else:
+            super().__setattr__(attr, obj)
+
+    @property
+    def idx(self):
+        return self.record["idx"]
+
+    @property
+    def level(self):
+        return self.record["level"]
+
+    @property
+    def data(self):
+        return self.data_manager.get_species_by_id(self.record["species_id"])
+
+    @property
+    def pretty_name(self):
+        name = ""
+        if self.record["shiny"]:
+            name += "\N{SPARKLES} "
+        if self.record["favorite"]:
+            name += "\N{REVOLVING HEARTS} "
+        name += self.data["name"].title()
+        if self.record["nick"]:
+            name += f' "{self.record["nick"]}"'
+        return name
+
+    @property
+    def iv_percent(self):
+        return self.record["total_iv"] / 186
+
+
 class Admin(commands.Cog):
     """Commands for bot administration"""
 
@@ -82,19 +136,25 @@ class Admin(commands.Cog):
         if not pokemon:
             return await ctx.send("invalid pokemon")
 
-        await ctx.bot.db.insert_pokemon(target, pokemon["species_id"], shiny=shiny)
+        if not await ctx.bot.db.insert_pokemon(
+            target, pokemon["species_id"], shiny=shiny
+        ):
+            return await ctx.send("That user has not started")
         await ctx.message.add_reaction("\U00002705")
 
     @dev.command()
     @commands.is_owner()
     async def benchmark(self, ctx, times=100):
-        """Benchmark postgresql"""
+        """Benchmark postgresql, nothing is kept"""
         insert = BenchmarkTime(0, 0, 999, -1)
         delete = BenchmarkTime(0, 0, 999, -1)
         update = BenchmarkTime(0, 0, 999, -1)
         query = BenchmarkTime(0, 0, 999, -1)
         async with ctx.bot.connection.acquire() as conn:
-            async with conn.transaction():
+            transaction = conn.transaction()
+            await transaction.start()
+            # rolled back so the inserts don't leave gaps in the user's idx counter
+            try:
                 for i in range(times):
                     with misc.StopWatch() as s:
                         pokemon = await ctx.bot.db.insert_pokemon(
@@ -119,6 +179,8 @@ class Admin(commands.Cog):
                             "DELETE FROM pokemon WHERE id = $1", pokemon.id
                         )
                     delete.update(s.time)
+            finally:
+                await transaction.rollback()
 
         await ctx.send(
             embed=constants.Embed(
@@ -130,6 +192,443 @@ class Admin(commands.Cog):
             .add_field(name="Query", value=str(query))
         )
 
+    @dev.command()
+    @commands.is_owner()
+    async def catchbench(self, ctx, times: int = 100):
+        """Benchmark the catch statement against the old multi statement catch, nothing is kept"""
+        db = ctx.bot.db
+        species = list(ctx.bot.data.data.keys())
+        old = BenchmarkTime(0, 0, 999, -1)
+        new = BenchmarkTime(0, 0, 999, -1)
+        async with ctx.bot.connection.acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                # the new path runs first as the old one allocates idx with MAX(idx)
+                for i in range(times):
+                    with misc.StopWatch() as s:
+                        await db.catch_pokemon(
+                            ctx.author, random.choice(species), connection=conn
+                        )
+                    new.update(s.time)
+
+                for i in range(times):
+                    species_id = random.choice(species)
+                    with misc.StopWatch() as s:
+                        idx = await conn.fetchval(
+                            "SELECT idx+1 FROM pokemon WHERE user_id = $1 ORDER BY idx DESC LIMIT 1",
+                            ctx.author.id,
+                        )
+                        await conn.fetchrow(
+                            "INSERT INTO pokemon(user_id, idx, species_id, level, xp, nature, shiny, hp_iv, atk_iv, def_iv, spatk_iv, spdef_iv, spd_iv, moves) VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14) RETURNING *",
+                            ctx.author.id,
+                            idx or 1,
+                            species_id,
+                            *db.random_pokemon_values(),
+                        )
+                        count = await conn.fetchval(
+                            "INSERT INTO dex(user_id, species_id, count) VALUES($1, $2, 1) ON CONFLICT(user_id, species_id) DO UPDATE SET count = dex.count+1 RETURNING count",
+                            ctx.author.id,
+                            species_id,
+                        )
+                        if count == 1 or count in (10, 100, 1000):
+                            await conn.execute(
+                                "UPDATE users SET bal = bal + (35 * $2) WHERE id = $1",
+                                ctx.author.id,
+                                count,
+                            )
+                    old.update(s.time)
+            finally:
+                await transaction.rollback()
+                db.dexes.invalidate(ctx.author.id)
+
+        await ctx.send(
+            embed=constants.Embed(
+                title="Benchmarks for catching", description=f"Of {times} times"
+            )
+            .add_field(name="Before (4-5 statements)", value=str(old))
+            .add_field(name="After (1 statement)", value=str(new))
+        )
+
+    @dev.command()
+    @commands.is_owner()
+    async def listbench(self, ctx, size: int = 100000, order_by="level"):
+        """Benchmark the pokemon listing for a synthetic user, nothing is kept"""
+        db = ctx.bot.db
+        user_id = 0  # not a valid discord id so it can't collide with a real user
+        pages = size // 15
+        timings = {}
+        async with ctx.bot.connection.acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                await conn.execute(
+                    "INSERT INTO users(id, selected, bal, redeem, next_idx) VALUES($1, 1, 0, 0, $2)",
+                    user_id,
+                    size + 1,
+                )
+                await conn.execute(
+                    "INSERT INTO pokemon(user_id, idx, species_id, level, xp, nature, shiny, hp_iv, atk_iv, def_iv, spatk_iv, spdef_iv, spd_iv, moves) "
+                    "SELECT $1, i, 1 + (random() * 800)::int, 1 + (random() * 99)::int, 0, 'Hardy', false, "
+                    "(random() * 31)::int, (random() * 31)::int, (random() * 31)::int, (random() * 31)::int, (random() * 31)::int, (random() * 31)::int, "
+                    "ARRAY['Tackle', 'Tackle', 'Tackle', 'Tackle'] FROM generate_series(1, $2) AS i",
+                    user_id,
+                    size,
+                )
+                await conn.execute("ANALYZE pokemon")
+
+                def old_query(page):
+                    return conn.fetch(
+                        f"SELECT * FROM (SELECT *, rank() over(order by ({order_by})) as rank FROM pokemon WHERE user_id = $1 AND market_price is NULL) as _ "
+                        "WHERE user_id = $1 AND market_price is NULL AND rank >= $2 AND rank <= $3 ORDER BY rank ASC",
+                        user_id,
+                        (page - 1) * 15 + 1,
+                        page * 15,
+                    )
+
+                for page in (1, pages // 2, pages):
+                    with misc.StopWatch() as s:
+                        await old_query(page)
+                        await conn.fetchval(
+                            "SELECT COUNT(id) FROM pokemon WHERE user_id = $1 AND market_price IS NULL",
+                            user_id,
+                        )
+                    timings[f"Before, page {page}"] = s.time
+
+                with misc.StopWatch() as s:
+                    records = await db.get_pokemon_page(
+                        user_id, order_by, with_total=True, connection=conn
+                    )
+                timings["After, page 1 with count"] = s.time
+
+                columns = db.order_columns(order_by)
+                next_page = BenchmarkTime(0, 0, 999, -1)
+                for page in range(2, min(pages, 50) + 1):
+                    with misc.StopWatch() as s:
+                        records = await db.get_pokemon_page(
+                            user_id,
+                            order_by,
+                            after=[records[-1][column] for column in columns],
+                            connection=conn,
+                        )
+                    next_page.update(s.time)
+
+                with misc.StopWatch() as s:
+                    await db.get_pokemon_page(
+                        user_id,
+                        order_by,
+                        offset=(pages - 1) * 15,
+                        with_total=True,
+                        connection=conn,
+                    )
+                timings[f"After, jump to page {pages}"] = s.time
+            finally:
+                await transaction.rollback()
+
+        embed = constants.Embed(
+            title="Benchmarks for the pokemon listing",
+            description=f"{size:,} pokemon ordered by {order_by}",
+        )
+        for name, value in timings.items():
+            embed.add_field(name=name, value=f"`{value*1000:,.2f}ms`")
+        embed.add_field(name="After, next page (keyset)", value=str(next_page))
+        await ctx.send(embed=embed)
+
+    @dev.command()
+    @commands.is_owner()
+    async def modelbench(self, ctx, times: int = 100):
+        """Benchmark pokemon model construction, rendering and memory using your pokemon"""
+        records = await ctx.bot.connection.fetch(
+            "SELECT * FROM pokemon WHERE user_id = $1 LIMIT 1000", ctx.author.id
+        )
+        if not records:
+            return await ctx.send("You need some pokemon to benchmark with")
+
+        def render(pokemon):
+            return f"`{pokemon.idx}` {pokemon.pretty_name} | Level: {pokemon.level} | IV: {pokemon.iv_percent*100:,.2f}%"
+
+        embed = constants.Embed(
+            title="Benchmarks for the pokemon model",
+            description=f"{len(records)} pokemon, {times} times",
+        )
+        for name, cls in (("Before", LegacyPokemon), ("After", models.Pokemon)):
+            with misc.StopWatch() as build:
+                for i in range(times):
+                    pokemons = [cls(record, ctx.bot.data) for record in records]
+            with misc.StopWatch() as draw:
+                for i in range(times):
+                    for pokemon in pokemons:
+                        render(pokemon)
+
+            tracemalloc.start()
+            kept = [cls(record, ctx.bot.data) for record in records]
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del kept
+
+            per = times * len(records)
+            embed.add_field(
+                name=name,
+                value=f"Construct: `{build.time/per*1e6:,.2f}µs`\nRender: `{draw.time/per*1e6:,.2f}µs`\nMemory: `{memory/len(records):,.0f}` bytes each",
+            )
+
+        await ctx.send(embed=embed)
+
+    @dev.command()
+    @commands.is_owner()
+    async def dexbench(self, ctx, times: int = 1000):
+        """Benchmark pokedex pages for a user with the complete dex against the old full sort"""
+        data = ctx.bot.data
+        cog = ctx.bot.get_cog("Pokemon")
+        records = [
+            dict(
+                user_id=0,
+                species_id=species_id,
+                count=random.randint(1, 500),
+                shinies=0,
+            )
+            for species_id in data.data
+        ]
+
+        def old_page(page, order):
+            dex = {
+                record["species_id"]: LegacyDexEntry(*record.values())
+                for record in records
+            }
+            entries = data.data
+            key = None
+            if order:
+
+                def key(item):
+                    if entry := dex.get(item):
+                        return 60000 + entry.count
+                    return item
+
+            dex = {i: v for i, v in dex.items() if i in entries}
+            ids = list(range((page - 1) * 20, page * 20))
+            return [
+                species_id
+                for idx, species_id in enumerate(sorted(entries.keys(), key=key))
+                if idx in ids
+            ]
+
+        pages = len(data.data) // 20 + 1
+        results = {}
+        for order in (None, "a"):
+            flags = types.SimpleNamespace(
+                legendary=False,
+                mythical=False,
+                ub=False,
+                caught=False,
+                uncaught=False,
+                order=order,
+            )
+            with misc.StopWatch() as old:
+                for i in range(times):
+                    old_page(i % pages + 1, order)
+            with misc.StopWatch() as new:
+                dex = models.Dex({r["species_id"]: r["count"] for r in records})
+                for i in range(times):
+                    cog.dex_page(dex, flags, i % pages + 1)
+            results[order] = (old.time, new.time)
+
+        embed = constants.Embed(
+            title="Benchmarks for the pokedex listing",
+            description=f"{times} page renders of a dex with all {len(records)} species caught",
+        )
+        for order, (old, new) in results.items():
+            embed.add_field(
+                name="By count" if order else "By id",
+                value=f"Before: `{old/times*1e6:,.1f}µs` per page\nAfter: `{new/times*1e6:,.1f}µs` per page",
+            )
+        await ctx.send(embed=embed)
+
+    @dev.command()
+    @commands.is_owner()
+    async def messagebench(self, ctx, times: int = 2000, commands_percent: int = 10):
+        """Benchmark how fast the spawning listener can tell chat from commands"""
+        spawning = ctx.bot.get_cog("Spawning")
+        words = ["hello", "pokemon", "catch", "lol", "gg", "anyone", "trade", "?"]
+        stream = []
+        for i in range(times):
+            message = copy.copy(ctx.message)
+            if random.randrange(100) < commands_percent:
+                message.content = f"{ctx.prefix}{random.choice(['help', 'ping', 'p', 'info', 'hint'])}"
+            else:
+                message.content = " ".join(
+                    random.choices(words, k=random.randint(1, 12))
+                )
+            stream.append(message)
+
+        with misc.StopWatch() as old:
+            for message in stream:
+                (await ctx.bot.get_context(message)).valid
+        with misc.StopWatch() as new:
+            for message in stream:
+                await spawning.is_command(message)
+
+        await ctx.send(
+            embed=constants.Embed(
+                title="Benchmarks for the spawning listener",
+                description=f"{times} messages, {commands_percent}% commands",
+            )
+            .add_field(
+                name="Before (get_context)", value=f"`{times/old.time:,.0f}` messages/s"
+            )
+            .add_field(
+                name="After (prefix match)", value=f"`{times/new.time:,.0f}` messages/s"
+            )
+        )
+
+    @dev.command()
+    @commands.is_owner()
+    async def spawnbench(self, ctx, times: int = 100000):
+        """Benchmark spawn selection against the old random.choices implementation"""
+        data = ctx.bot.data
+
+        def old_random_pokemon():
+            pokemon = list(data.data.values())
+            return random.choices(
+                pokemon, weights=[x.get("abundance", 0) for x in pokemon], k=1
+            )[0]
+
+        table = data.spawn_table()
+        old_times = max(times // 100, 1)
+        with misc.StopWatch() as old:
+            for _ in range(old_times):
+                old_random_pokemon()
+        with misc.StopWatch() as new:
+            samples = table.sample(times)
+
+        # total variation distance and chi squared against the expected weights
+        counts = Counter(poke["species_id"] for poke in samples)
+        distance = 0
+        chi_squared = 0
+        for index, poke in enumerate(table.items):
+            expected = table.probability(index)
+            distance += abs(counts[poke["species_id"]] / times - expected)
+            if expected:
+                chi_squared += (counts[poke["species_id"]] - expected * times) ** 2 / (
+                    expected * times
+                )
+
+        await ctx.send(
+            embed=constants.Embed(
+                title="Benchmarks for spawn selection",
+                description=f"Of {times} draws ({old_times} for random.choices)",
+            )
+            .add_field(
+                name="random.choices",
+                value=f"`{old.time/old_times*1e6:,.2f}µs` per draw",
+            )
+            .add_field(
+                name="Alias table", value=f"`{new.time/times*1e6:,.2f}µs` per draw"
+            )
+            .add_field(
+                name="Distribution",
+                value=f"Total variation: `{distance/2:.4f}`\nChi squared: `{chi_squared:,.1f}` ({len(table) - 1} dof)",
+                inline=False,
+            )
+        )
+
+    @dev.command()
+    @commands.is_owner()
+    async def roundtrips(self, ctx, limit: int = 15):
+        """View the average database round trips made by each command"""
+        stats = sorted(
+            ctx.bot.round_trips.items(), key=lambda x: x[1][1] / x[1][0], reverse=True
+        )
+        if not stats:
+            return await ctx.send("No commands have been run yet")
+        await ctx.send(
+            embed=constants.Embed(
+                title="Database round trips per command",
+                description="\n".join(
+                    f"`{name}`: {trips / runs:,.2f} avg over {runs:,} runs"
+                    for name, (runs, trips) in stats[:limit]
+                ),
+            )
+        )
+
+    @dev.command()
+    @commands.is_owner()
+    async def dbstats(self, ctx):
+        """View the connection pool's saturation and query latencies"""
+        pool = ctx.bot.connection
+        stats = connection.stats
+        waits = "\n".join(
+            (
+                f"≤ {bound * 1000:,.0f}ms: {count:,}"
+                if bound != float("inf")
+                else f"> {connection.WAIT_BUCKETS[-2] * 1000:,.0f}ms: {count:,}"
+            )
+            for bound, count in zip(connection.WAIT_BUCKETS, stats.waits)
+        )
+        p50, p95, p99 = stats.percentiles(50, 95, 99)
+        await ctx.send(
+            embed=constants.Embed(title="Database pool")
+            .add_field(
+                name="Connections",
+                value=(
+                    f"Open: `{pool.get_size()}` ({pool.get_min_size()}-{pool.get_max_size()})\n"
+                    f"Idle: `{pool.get_idle_size()}`\n"
+                    f"In use: `{stats.in_use}` (max `{stats.max_in_use}`)\n"
+                    f"Acquire timeouts: `{stats.timeouts:,}`"
+                ),
+            )
+            .add_field(name="Acquire wait", value=waits)
+            .add_field(
+                name="Query latency",
+                value=(
+                    f"Of the last {len(stats.latencies):,} queries\n"
+                    f"p50: `{p50 * 1000:,.2f}ms`\n"
+                    f"p95: `{p95 * 1000:,.2f}ms`\n"
+                    f"p99: `{p99 * 1000:,.2f}ms`"
+                ),
+            )
+        )
+
+    @dev.command()
+    @commands.is_owner()
+    async def queries(
+        self,
+        ctx,
+        sort: Literal["total", "avg", "max", "calls"] = "total",
+        limit: int = 8,
+    ):
+        """View the slowest query shapes since startup"""
+        keys = {
+            "total": lambda shape: shape.total,
+            "avg": lambda shape: shape.total / shape.calls,
+            "max": lambda shape: shape.max,
+            "calls": lambda shape: shape.calls,
+        }
+        shapes = sorted(
+            connection.queries.shapes.items(),
+            key=lambda x: keys[sort](x[1]),
+            reverse=True,
+        )
+        if not shapes:
+            return await ctx.send("No queries have been run yet")
+
+        embed = constants.Embed(
+            title="Queries",
+            description=f"Sorted by {sort}, slow queries are logged over {connection.queries.slow * 1000:,.0f}ms",
+        )
+        for query, shape in shapes[:limit]:
+            embed.add_field(
+                name=textwrap.shorten(query, 250),
+                value=(
+                    f"Calls: `{shape.calls:,}` Params: `{shape.params}`\n"
+                    f"Avg: `{shape.total / shape.calls * 1000:,.2f}ms` "
+                    f"p95: `{shape.percentile(95) * 1000:,.2f}ms` "
+                    f"Max: `{shape.max * 1000:,.2f}ms`\n"
+                    f"Commands: {', '.join(sorted(shape.commands)[:5]) or 'none'}"
+                ),
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
     @dev.command()
     @commands.is_owner()
     async def suspend(self, ctx, target: discord.User):
@@ -137,6 +636,7 @@ class Admin(commands.Cog):
         await ctx.bot.connection.execute(
             "UPDATE users SET disabled=true WHERE id = $1", target.id
         )
+        await ctx.bot.db.invalidate("users", target)
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
     @dev.command()
@@ -146,6 +646,7 @@ class Admin(commands.Cog):
         await ctx.bot.connection.execute(
             "UPDATE users SET disabled=false WHERE id = $1", target.id
         )
+        await ctx.bot.db.invalidate("users", target)
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
     @dev.command()
@@ -294,6 +795,34 @@ class Admin(commands.Cog):
             value=f"Memory: `{memory.used/1000000:,.2f}` MiB used out of `{memory.total/1000000:,.2f}` MiB(`{memory.percent}` percent)\n Booted at {boot_time}",
         )
 
+        if spawning := ctx.bot.get_cog("Spawning"):
+            active = sum(1 for spawn in spawning.spawns.values() if spawn["pokemon"])
+            embed.add_field(
+                name="Spawning",
+                value=f"Channels: `{len(spawning.spawns):,}` (`{active:,}` active)\nCooldowns: `{len(spawning.cooldown):,}`\nBuffered xp: `{len(spawning.xp):,}`",
+            )
+
+        db = ctx.bot.db
+        disabled_size = sum(
+            sys.getsizeof(channels) + sum(map(sys.getsizeof, channels))
+            for channels in (db.commands_disabled, db.spawns_disabled)
+        )
+        from_memory = 1 - db.channel_fallbacks / max(db.channel_checks, 1)
+        caches = "\n".join(
+            f"{table.title()}: `{len(cache):,}` (`{cache.hits / max(cache.hits + cache.misses, 1):.1%}` hits)"
+            for table, cache in db.caches.items()
+        )
+        embed.add_field(
+            name="Settings",
+            value=(
+                f"Disabled channels: `{len(db.commands_disabled):,}` commands, `{len(db.spawns_disabled):,}` spawns (`{disabled_size / 1024:,.1f}` KiB)\n"
+                f"Channel checks: `{db.channel_checks:,}` (`{from_memory:.1%}` from memory)\n"
+                f"Started users: `{len(db.started):,}` (`{db.started.nbytes / 1024 ** 2:,.1f}` MiB)\n"
+                f"Prefixes: `{len(db.prefixes):,}`\n{caches}"
+            ),
+            inline=False,
+        )
+
         await ctx.send(embed=embed)
 
 
@@ -36,7 +36,7 @@ class Bot(commands.Cog):
             self.PING_REGEX = re.compile(f"<@!?{self.bot.user.id}>")
 
         if self.PING_REGEX.fullmatch(message.content):
-            prefix = await self.bot.get_cog("Meta").get_prefix(message.guild)
+            prefix = self.bot.get_cog("Meta").get_prefix(message.guild)
             embed = constants.Embed(
                 title="Hello!",
                 description=f"I see you've pinged me.\n My prefix for this server is: `{prefix}` You can also mention me!",
@@ -12,7 +12,7 @@ class Economy(commands.Cog):
     @checks.has_started()
     async def balance(self, ctx):
         """View your current balance"""
-        user = await self.bot.db.get_user(ctx.author)
+        user = ctx.user
         embed = constants.Embed(
             title=f"{ctx.author.display_name}'s balance",
             description=f"{user.bal:,} credits",
@@ -27,7 +27,7 @@ class Economy(commands.Cog):
     async def redeem(self, ctx, pokemon=None):
         """Redeem credits or a pokemon"""
         # NOTE: This command is so long because of slash commands, we cannot make sub and group commands
-        user = await self.bot.db.get_user(ctx.author)
+        user = ctx.user
         if pokemon is None:
             embed = constants.Embed(
                 title=f"Your Redeems: {user.redeem}",
@@ -51,9 +51,10 @@ class Economy(commands.Cog):
                 "UPDATE users SET redeem=redeem-1, bal=bal+15000 WHERE id = $1",
                 ctx.author.id,
             )
+            await self.bot.db.invalidate("users", ctx.author, refresh=False)
             await ctx.send("Money added!")
         else:
-            pokemon = self.bot.data.get_species_by_name(pokemon)
+            pokemon = self.bot.data.get_species_by_name(pokemon, fuzzy=True)
             if not pokemon:
                 return await ctx.send("Thats not a valid pokenmon!")
 
@@ -65,6 +66,7 @@ class Economy(commands.Cog):
                     await connection.execute(
                         "UPDATE users SET redeem=redeem-1 WHERE id = $1", ctx.author.id
                     )
+            await self.bot.db.invalidate("users", ctx.author, refresh=False)
             await ctx.send("You have redeemed a pikachu")
 
     # @commands.command(aliases=("rs", ))
@@ -1,16 +1,9 @@
-import datetime
-from typing import NamedTuple
-
 from discord import file
 
+import asyncio
 import discord
 from helpers import constants, misc
-from discord.ext import commands
-
-
-class ExpiredCache(NamedTuple):
-    count: int
-    expires: datetime.datetime
+from discord.ext import commands, tasks
 
 
 class TutorialSelect(discord.ui.Select):
@@ -78,32 +71,63 @@ class Information(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.user_count = None
-        self.pokemon_count = None
         self.bot.help_command.cog = self
+        # totals refreshed in the background so botinfo never counts a table
+        self.pokemon_count = None
+        self.guild_counts = {}
+        # held while counting, so botinfo waits on the loop's first run
+        self.counts_lock = asyncio.Lock()
+        self.refresh_counts_loop.start()
+
+    def cog_unload(self):
+        self.refresh_counts_loop.cancel()
+
+    @tasks.loop(minutes=10)
+    async def refresh_counts_loop(self):
+        try:
+            async with self.counts_lock:
+                await self.refresh_counts()
+        except Exception as error:
+            self.bot.logger.warning(
+                "Count Refresh Failed", extra={"error": repr(error)}
+            )
 
-    async def count_users(self):
-        if self.user_count and self.user_count.expires >= datetime.datetime.utcnow():
-            return self.user_count.count
-        else:
-            self.user_count = ExpiredCache(
-                await self.bot.connection.fetchval("SELECT COUNT(id) FROM users"),
-                datetime.datetime.utcnow(),
+    async def refresh_counts(self):
+        # the planner's estimate, kept current by autovacuum, instead of a scan
+        # of our largest table. Until the table is first analyzed it is -1, or 0
+        # before PostgreSQL 14
+        estimate = await self.bot.connection.fetchval(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = 'pokemon'::regclass"
+        )
+        if estimate <= 0:
+            estimate = await self.bot.connection.fetchval(
+                "SELECT COUNT(id) FROM pokemon"
             )
-            return self.user_count.count
+        self.pokemon_count = estimate
+        self.guild_counts.clear()
+
+    async def count_users(self):
+        if self.bot.db.loaded:
+            return len(self.bot.db.started)
+        return await self.bot.connection.fetchval(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = 'users'::regclass"
+        )
 
     async def count_pokemon(self):
-        if (
-            self.pokemon_count
-            and self.pokemon_count.expires >= datetime.datetime.utcnow()
-        ):
-            return self.pokemon_count.count
-        else:
-            self.pokemon_count = ExpiredCache(
-                await self.bot.connection.fetchval("SELECT COUNT(id) FROM pokemon"),
-                datetime.datetime.utcnow(),
+        if self.pokemon_count is None:
+            async with self.counts_lock:
+                if self.pokemon_count is None:
+                    await self.refresh_counts()
+        return self.pokemon_count
+
+    def count_guild_users(self, guild):
+        """How many of the guild's cached members have started"""
+        if (count := self.guild_counts.get(guild.id)) is None:
+            started = self.bot.db.started
+            count = self.guild_counts[guild.id] = sum(
+                1 for member in guild.members if member.id in started
             )
-            return self.pokemon_count.count
+        return count
 
     @commands.command(aliases=("bot",))
     async def botinfo(self, ctx):
@@ -2,11 +2,11 @@ import io
 import discord
 import traceback
 
-from async_lru import alru_cache
 from typing import Literal, Union
 
 from discord.ext import commands
 from helpers import constants, misc, checks
+from helpers.database import MISSING
 
 
 class Meta(commands.Cog):
@@ -14,23 +14,41 @@ class Meta(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # guilds with a prefix lookup in flight, so a busy guild only starts one
+        self.prefix_lookups = set()
 
     async def bot_check(self, ctx):
-        channel = await self.bot.db.get_channel(ctx.channel)
-        if not channel:
-            return True
-        if channel.disabled and ctx.command != self.enable:
+        db = self.bot.db
+        db.channel_checks += 1
+        if db.loaded:
+            disabled = ctx.channel.id in db.commands_disabled
+        else:
+            db.channel_fallbacks += 1
+            channel = await ctx.channel_row
+            disabled = channel and channel.disabled
+        if disabled and ctx.command != self.enable:
             raise commands.CheckFailure(
                 "Commands in this channel are currently disabled!"
             )
         return True
 
-    @alru_cache()
-    async def get_prefix(self, guild):
-        guild = await self.bot.db.get_guild(guild.id)
+    def get_prefix(self, guild):
         if not guild:
             return self.bot.config.prefix
-        return guild.prefix or self.bot.config.prefix
+        prefix = self.bot.db.prefixes.get(guild.id)
+        if prefix is MISSING:
+            # not every guild fits in the map, look this one up for next time
+            if guild.id not in self.prefix_lookups:
+                self.prefix_lookups.add(guild.id)
+                self.bot.loop.create_task(self.lookup_prefix(guild.id))
+            prefix = None
+        return prefix or self.bot.config.prefix
+
+    async def lookup_prefix(self, guild_id):
+        try:
+            await self.bot.db.refresh_settings("guilds", guild_id)
+        finally:
+            self.prefix_lookups.discard(guild_id)
 
     @commands.command(usage="<commands/spawns>")
     @commands.has_guild_permissions(manage_guild=True)
@@ -44,12 +62,15 @@ class Meta(commands.Cog):
                 ctx.channel.id,
                 ctx.guild.id,
             )
+            self.bot.db.commands_disabled.add(ctx.channel.id)
         else:
             await self.bot.connection.execute(
                 "INSERT INTO channels(id, guild_id, spawns_disabled) VALUES($1, $2, true) ON CONFLICT(id) DO UPDATE SET spawns_disabled=true",
                 ctx.channel.id,
                 ctx.guild.id,
             )
+            self.bot.db.spawns_disabled.add(ctx.channel.id)
+        await self.bot.db.invalidate("channels", ctx.channel)
 
         await ctx.send(f"I have disabled `{feature}`")
 
@@ -63,11 +84,14 @@ class Meta(commands.Cog):
             await self.bot.connection.execute(
                 "UPDATE channels SET disabled = false WHERE id = $1", ctx.channel.id
             )
+            self.bot.db.commands_disabled.discard(ctx.channel.id)
         else:
             await self.bot.connection.execute(
                 "UPDATE channels SET spawns_disabled = false WHERE id = $1",
                 ctx.channel.id,
             )
+            self.bot.db.spawns_disabled.discard(ctx.channel.id)
+        await self.bot.db.invalidate("channels", ctx.channel)
 
         await ctx.send(f"I have enabled `{feature}`")
 
@@ -87,6 +111,7 @@ class Meta(commands.Cog):
                 ctx.guild.id,
                 option,
             )
+        await self.bot.db.invalidate("guilds", ctx.guild)
 
         if toggle:
             await ctx.send("Alright, I will compact images")
@@ -110,6 +135,7 @@ class Meta(commands.Cog):
             ctx.guild.id,
             [channel.id for channel in channels],
         )
+        await self.bot.db.invalidate("guilds", ctx.guild)
         await ctx.send(
             f"Set the redirects to {', '.join(channel.mention for channel in channels)} All pokemon will be redirected to these channels!"
         )
@@ -130,6 +156,11 @@ class Meta(commands.Cog):
                 ctx.author.id,
                 option,
             )
+        await self.bot.db.invalidate("users", ctx.author, refresh=False)
+
+        if spawning := self.bot.get_cog("Spawning"):
+            if entry := spawning.xp.get(ctx.author.id):
+                entry["hide_levelup"] = toggle
 
         if toggle:
             await ctx.send("Alright, I will no longer send levelup messages.")
@@ -140,7 +171,7 @@ class Meta(commands.Cog):
     async def prefix(self, ctx):
         """The group command for prefix management, use with no subcommand to view current prefix"""
         await ctx.send(
-            f"The current prefix is `{await self.get_prefix(ctx.channel.guild)}` You can also mention me!"
+            f"The current prefix is `{self.get_prefix(ctx.guild)}` You can also mention me!"
         )
 
     @prefix.command()
@@ -153,7 +184,8 @@ class Meta(commands.Cog):
             ctx.guild.id,
             prefix,
         )
-        self.get_prefix.invalidate(self, ctx.guild)
+        self.bot.db.prefixes.set(ctx.guild.id, prefix)
+        await self.bot.db.invalidate("guilds", ctx.guild)
         await ctx.send(f"Set the server prefix to `{prefix}`")
 
     @prefix.command()
@@ -164,7 +196,8 @@ class Meta(commands.Cog):
         await self.bot.connection.execute(
             "UPDATE guilds SET prefix=$1 WHERE id = $2", None, ctx.guild.id
         )
-        self.get_prefix.invalidate(self, ctx.guild)
+        self.bot.db.prefixes.set(ctx.guild.id, None)
+        await self.bot.db.invalidate("guilds", ctx.guild)
         await ctx.send(f"Reset the guild prefix to `{self.bot.config.prefix}`")
 
     @commands.command()
@@ -1,4 +1,6 @@
+import time
 import discord
+import itertools
 import typing
 
 import re
@@ -51,7 +53,7 @@ class Pokemon(commands.Cog):
     @commands.command()
     async def pick(self, ctx, *, pokemon: str):
         """Select your starter"""
-        pokemon = self.bot.data.get_species_by_name(pokemon)
+        pokemon = self.bot.data.get_species_by_name(pokemon, fuzzy=True)
         if not pokemon:
             return await ctx.send("Thats not a valid pokemon!")
         starters = [
@@ -69,6 +71,7 @@ class Pokemon(commands.Cog):
                 await self.bot.db.insert_pokemon(
                     ctx.author, pokemon["species_id"], connection=conn
                 )
+        await self.bot.db.invalidate("users", ctx.author)
 
         await ctx.send(
             f"You have begun your journey! Use `{ctx.prefix}info` to view your new friend and `{ctx.prefix}pokemon` to view all your pokemon!"
@@ -102,7 +105,7 @@ class Pokemon(commands.Cog):
             embed.add_field(name="Held Item", value=pokemon.item)
 
         embed.compact_image(
-            await self.bot.db.get_guild(ctx.guild),
+            await ctx.guild_row,
             url=self.bot.data.image(pokemon.species_id, pokemon.shiny),
         )
 
@@ -116,34 +119,60 @@ class Pokemon(commands.Cog):
         self, ctx, page: typing.Optional[int] = 1, *, flags: PokemonFilters = None
     ):
         """View your pokemon"""
-        constraints, args = self.bot.db.format_query_from_flags(flags, start=4)
-
-        lower = (page - 1) * 15 + 1
-        upper = (page) * 15
-        query = f"SELECT * FROM (SELECT *, rank() over(order by ({(await self.bot.db.get_user(ctx.author)).order_by})) as rank FROM pokemon WHERE user_id = $1 AND market_price is NULL {constraints}) as _ WHERE user_id = $1 AND market_price is NULL AND rank >= $2 AND rank <= $3 {constraints} ORDER BY rank ASC"
-        pokemons = [
-            models.Pokemon(pokemon, self.bot.data)
-            for pokemon in await self.bot.connection.fetch(
-                query,
-                ctx.author.id,
-                lower,
-                upper,
-                *args,
+        if spawning := self.bot.get_cog("Spawning"):
+            await spawning.flush_xp(ctx.author.id)
+        page = max(page, 1)
+        user = ctx.user
+        columns = self.bot.db.order_columns(user.order_by)
+        constraints, args = self.bot.db.format_query_from_flags(flags)
+        key = (tuple(columns), constraints, repr(args))
+
+        cursors = self.bot.db.get_cursors(ctx.author.id)
+        cursor = cursors.get(key)
+        if cursor and cursor["expires"] < time.monotonic():
+            cursor = None
+        start = None
+        if cursor:
+            start = max((p for p in cursor["pages"] if p < page), default=None)
+
+        if start is None:
+            records = await self.bot.db.get_pokemon_page(
+                ctx.author,
+                user.order_by,
+                flags=flags,
+                offset=(page - 1) * 15,
+                with_total=True,
             )
-        ]
-        constraints, _ = self.bot.db.format_query_from_flags(flags, start=2)
-        size = await self.bot.connection.fetchval(
-            f"SELECT COUNT(id) FROM pokemon WHERE user_id = $1 AND market_price = NULL{constraints}",
-            ctx.author.id,
-            *args,
-        )
-        if not pokemons:
+            cursor = dict(
+                pages={},
+                total=records[0]["total"] if records else 0,
+                expires=time.monotonic() + 300,
+            )
+        else:
+            records = await self.bot.db.get_pokemon_page(
+                ctx.author,
+                user.order_by,
+                flags=flags,
+                offset=(page - 1 - start) * 15,
+                after=cursor["pages"][start],
+            )
+
+        if not records:
             return await ctx.send("No pokémon found.")
+
+        cursor["pages"][page] = tuple(records[-1][column] for column in columns)
+        cursors.pop(key, None)
+        cursors[key] = cursor
+        if len(cursors) > 20:
+            del cursors[next(iter(cursors))]
+
+        pokemons = [models.Pokemon(record, self.bot.data) for record in records]
+        lower = (page - 1) * 15 + 1
         num = max([pokemon.idx for pokemon in pokemons])
         length = len(str(num))
         embed = constants.Embed(title="Your pokemon:", description="")
         embed.set_footer(
-            text=f"Displaying {lower}-{min([upper, len(pokemons)])} of {size} pokémon"
+            text=f"Displaying {lower}-{lower + len(pokemons) - 1} of {cursor['total']} pokémon"
         )
         for pokemon in pokemons:
             st = f"`{pokemon.idx:>{length}}` {pokemon.pretty_name} | Level: {pokemon.level} | IV: {pokemon.iv_percent*100:,.2f}%\n"
@@ -155,9 +184,12 @@ class Pokemon(commands.Cog):
     @checks.has_started()
     async def select(self, ctx, pokemon: converters.PokemonConverter):
         """Select a new pokemon to levelup"""
+        if spawning := self.bot.get_cog("Spawning"):
+            await spawning.flush_xp(ctx.author.id)
         await self.bot.connection.execute(
             "UPDATE users SET selected = $1 WHERE id = $2", pokemon.idx, ctx.author.id
         )
+        await self.bot.db.invalidate("users", ctx.author, refresh=False)
         await ctx.send(f"Selected {pokemon.pretty_name}, id: {pokemon.idx}")
 
     @commands.command(aliases=("nick", "rename"))
@@ -181,9 +213,8 @@ class Pokemon(commands.Cog):
             await self.bot.db.update_selected_pokemon(ctx.author, dict(favorite=True))
             return await ctx.send("You have favorited your selected pokemon")
 
-        await self.bot.db.update_pokemon_by_idx(
-            ctx.author, pokemon.idx, dict(favorite=True)
-        )
+        pokemon.favorite = True
+        await self.bot.db.save_pokemon(pokemon)
         await ctx.send(f"You have favorited the pokemon with the id of {pokemon.idx}")
 
     @commands.command(aliases=("removefav", "removefavorite", "unfav"))
@@ -221,11 +252,39 @@ class Pokemon(commands.Cog):
         )
         embed.add_field(name="Types", value=(", ".join(pokemon["types"])))
         embed.compact_image(
-            await self.bot.db.get_guild(ctx.guild),
+            await ctx.guild_row,
             url=self.bot.data.image(pokemon["species_id"], shiny=shiny),
         )
         await ctx.send(embed=embed)
 
+    def dex_page(self, dex, flags, page, per_page=20):
+        """The species shown on a page of the pokedex listing, and the totals for it"""
+        rarity = None
+        if flags and flags.legendary:
+            rarity = "legendary"
+        elif flags and flags.mythical:
+            rarity = "mythical"
+        elif flags and flags.ub:
+            rarity = "ultra_beast"
+        order = self.bot.data.dex_order(rarity)
+        caught = dex.total(rarity, order)
+        total = len(order)
+
+        if flags and flags.order:
+            order = dex.by_count(rarity, order, reverse=flags.order == "d")
+
+        start = max(page - 1, 0) * per_page
+        if flags and (flags.caught or flags.uncaught):
+            wanted = bool(flags.caught)
+            order = (s for s in order if (s in dex.counts) == wanted)
+            total = caught if wanted else total - caught
+            caught = caught if wanted else 0
+            species = list(itertools.islice(order, start, start + per_page))
+        else:
+            species = order[start : start + per_page]
+
+        return dict(species=species, caught=caught, total=total)
+
     @commands.command(aliases=("dex", "d"), usage="<pokemon/page>")
     async def pokedex(self, ctx, *args):
         """View infomation on a pokemon or view all your dex infomation on pokemon"""
@@ -250,56 +309,17 @@ class Pokemon(commands.Cog):
                 flags = None
 
             dex = await ctx.bot.db.get_dex(ctx.author)
-            entries = self.bot.data.data
-            key = None
-            reverse = False
-            if flags:
-                if flags.caught:
-                    entries = {
-                        species_id: data
-                        for species_id, data in entries.items()
-                        if dex.get(species_id)
-                    }
-                elif flags.uncaught:
-                    entries = {
-                        species_id: data
-                        for species_id, data in entries.items()
-                        if not dex.get(species_id)
-                    }
-
-                if flags.order:
-
-                    def key(item):
-                        if entry := dex.get(item):
-                            return 60000 + entry.count
-                        return item
-
-                    if flags.order == "d":
-                        reverse = True
-
-                if flags.legendary:
-                    entries = self.bot.data.legendary
-                elif flags.mythical:
-                    entries = self.bot.data.mythical
-                elif flags.ub:
-                    entries = self.bot.data.ultra_beast
-
-            dex = {i: v for i, v in dex.items() if i in entries}
-            ids = list(range((page - 1) * 20, page * 20))
+            entries = self.dex_page(dex, flags, page)
 
             embed = constants.Embed(
                 title="Pokédex",
-                description=f"You've caught {len(dex)} of {len(entries)} pokémon.",
+                description=f"You've caught {entries['caught']} of {entries['total']} pokémon.",
             )
 
-            for idx, species_id in enumerate(
-                sorted(entries.keys(), key=key, reverse=reverse)
-            ):
-                data = entries[species_id]
-                if idx not in ids:
-                    continue
-                if entry := dex.get(species_id):
-                    message = f"{entry.count} caught!" " \N{WHITE HEAVY CHECK MARK}"
+            for species_id in entries["species"]:
+                data = self.bot.data.data[species_id]
+                if count := dex.counts.get(species_id):
+                    message = f"{count} caught!" " \N{WHITE HEAVY CHECK MARK}"
                 else:
                     message = "Not caught yet! \N{CROSS MARK}"
                 embed.add_field(name=f"{data['english']} #{species_id}", value=message)
@@ -1,9 +1,12 @@
+import os
 import asyncio
 import typing
 import json
+import hashlib
 import inspect
 from dataclasses import dataclass
-from helpers import methods
+from helpers import methods, connection
+from helpers.context import RowsMixin
 from typing import Union, Optional
 import datetime
 
@@ -11,6 +14,10 @@ import datetime
 import discord
 from discord.ext import commands
 
+# the schema last uploaded to discord and its hash, so unchanged schemas are not
+# uploaded again on every start
+SCHEMA_CACHE = "slash_commands.json"
+
 
 @dataclass
 class FakeUser:
@@ -33,7 +40,7 @@ class FalseMessage:
 
 
 @dataclass
-class SlashContext:
+class SlashContext(RowsMixin):
     bot: commands.Bot
     author: Union[discord.Member, discord.User]
     channel: Union[discord.TextChannel, discord.DMChannel]
@@ -73,6 +80,15 @@ class Slash(commands.Cog):
         discord.TextChannel: 7,
         discord.Role: 8,
     }
+    # (command, parameter) taking a species name, completed from the name index
+    AUTOCOMPLETE = {
+        ("catch", "pokemon"),
+        ("pick", "pokemon"),
+        ("redeem", "pokemon"),
+        ("pokedex", "args"),
+    }
+    AUTOCOMPLETE_INTERACTION = 4
+    AUTOCOMPLETE_RESULT = 8
     DISCORD_TYPES = [
         str,
         int,
@@ -87,7 +103,8 @@ class Slash(commands.Cog):
         self.bot = bot
         self.bot.loop.create_task(self.build_slash_commands())
 
-    async def parse_options(self, command):
+    @classmethod
+    def parse_options(cls, command):
         if isinstance(command, commands.Group):
             return [
                 {
@@ -96,9 +113,9 @@ class Slash(commands.Cog):
                         command.help or "no decription", 100
                     ),
                     "type": 1,
-                    "options": await self.parse_options(command),
+                    "options": cls.parse_options(command),
                 }
-                for command in command.commands
+                for command in sorted(command.commands, key=lambda c: c.name)
             ]
 
         signature = command.clean_params
@@ -114,17 +131,17 @@ class Slash(commands.Cog):
                 type = param.annotation
                 required = param.default == inspect.Parameter.empty
 
-            if self.is_flag(param.annotation):
+            if cls.is_flag(param.annotation):
                 for name, flag in param.annotation.get_flags().items():
                     if flag.default != ...:
                         required = False
                     else:
                         required = True
                     type = flag.annotation
-                    if type in self.DISCORD_TYPES:
-                        type = self.TYPES[type]
+                    if type in cls.DISCORD_TYPES:
+                        type = cls.TYPES[type]
                     else:
-                        type = self.TYPES[str]
+                        type = cls.TYPES[str]
                     options.append(
                         {
                             "name": name,
@@ -135,12 +152,12 @@ class Slash(commands.Cog):
                     )
                 continue
 
-            if type in self.DISCORD_TYPES:
+            if type in cls.DISCORD_TYPES:
                 options.append(
                     {
                         "name": name,
                         "description": name,
-                        "type": self.TYPES[type],
+                        "type": cls.TYPES[type],
                         "required": required,
                     }
                 )
@@ -149,33 +166,81 @@ class Slash(commands.Cog):
                     {
                         "name": name,
                         "description": name,
-                        "type": self.TYPES[str],
+                        "type": cls.TYPES[str],
                         "required": required,
                     }
                 )
+            autocomplete = (command.qualified_name, name) in cls.AUTOCOMPLETE
+            if autocomplete and options[-1]["type"] == cls.TYPES[str]:
+                options[-1]["autocomplete"] = True
         return options
 
-    async def build_slash_commands(self):
-        await self.bot.wait_until_ready()
-        cmds = [
+    @classmethod
+    def build_schema(cls, bot_commands):
+        """The slash command schema of the commands, this needs no connection to discord"""
+        return [
             {
                 "name": command.name,
                 "description": methods.format_string(
                     command.help or "no description", 100
                 ),
-                "options": await self.parse_options(command),
+                "options": cls.parse_options(command),
             }
-            for command in self.bot.commands
+            for command in sorted(bot_commands, key=lambda c: c.name)
             if command.qualified_name != "jishaku"
         ]
+
+    @staticmethod
+    def schema_hash(application_id, schema):
+        content = json.dumps([application_id, schema], sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def load_schema_cache(self):
+        try:
+            with open(SCHEMA_CACHE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_schema_cache(self, cache):
+        try:
+            with open(f"{SCHEMA_CACHE}.tmp", "w") as f:
+                json.dump(cache, f)
+            os.replace(f"{SCHEMA_CACHE}.tmp", SCHEMA_CACHE)
+        except OSError:
+            pass
+
+    async def build_slash_commands(self):
+        await self.bot.wait_until_ready()
+        cmds = self.build_schema(self.bot.commands)
         if self.bot.config.debug:
             with open("test.json", "w") as f:
                 json.dump(cmds, f, indent=4)
+
+        digest = self.schema_hash(self.bot.user.id, cmds)
+        cache = self.load_schema_cache()
+        if cache.get("hash") == digest:
+            return
+
         url = f"{discord.http.Route.BASE}/applications/{self.bot.user.id}/commands"
         headers = {"Authorization": f"Bot {self.bot.http.token}"}
         async with self.bot.session.put(url, headers=headers, json=cmds) as resp:
             resp.raise_for_status()
 
+        old = {command["name"]: command for command in cache.get("schema", [])}
+        new = {command["name"]: command for command in cmds}
+        self.bot.logger.info(
+            "Slash Commands Synced",
+            extra={
+                "added": sorted(new.keys() - old.keys()),
+                "removed": sorted(old.keys() - new.keys()),
+                "changed": sorted(
+                    name for name in new.keys() & old.keys() if new[name] != old[name]
+                ),
+            },
+        )
+        self.save_schema_cache(dict(hash=digest, schema=cmds))
+
     async def real_convert(self, ctx, option, param):
         if option["type"] == 6:
             data = ctx.interaction.data["resolved"]["users"][option["value"]]
@@ -197,15 +262,46 @@ class Slash(commands.Cog):
             return value
         return option["value"]
 
-    def is_flag(self, annotation):
+    @staticmethod
+    def is_flag(annotation):
         return (
             inspect.isclass(annotation)
             and issubclass(annotation, commands.FlagConverter)
         ) or isinstance(annotation, commands.FlagConverter)
 
+    def focused_option(self, command, options):
+        """The qualified name of the command and the option being typed in"""
+        for option in options:
+            if option.get("focused"):
+                return command, option
+            if option["type"] in {1, 2}:
+                return self.focused_option(
+                    f"{command} {option['name']}", option.get("options", [])
+                )
+        return command, None
+
+    async def autocomplete(self, interaction):
+        command, option = self.focused_option(
+            interaction.data["name"], interaction.data.get("options", [])
+        )
+        if not option or (command, option["name"]) not in self.AUTOCOMPLETE:
+            choices = []
+        else:
+            choices = [
+                {"name": poke["english"], "value": poke["name"]}
+                for poke in self.bot.data.search_species(str(option["value"]))
+            ]
+        url = f"{discord.http.Route.BASE}/interactions/{interaction.id}/{interaction.token}/callback"
+        payload = {"type": self.AUTOCOMPLETE_RESULT, "data": {"choices": choices}}
+        async with self.bot.session.post(url, json=payload) as resp:
+            resp.raise_for_status()
+
     @commands.Cog.listener()
     async def on_interaction(self, interaction: discord.Interaction):
         """Bad idea test"""
+        if interaction.type.value == self.AUTOCOMPLETE_INTERACTION:
+            return await self.autocomplete(interaction)
+
         if interaction.type != discord.InteractionType.application_command:
             return
 
@@ -237,6 +333,14 @@ class Slash(commands.Cog):
             command,
             interaction,
         )
+        token = connection.current_context.set(ctx)
+        try:
+            await self.invoke(ctx, command, options, interaction)
+        finally:
+            connection.current_context.reset(token)
+            self.bot.record_round_trips(ctx)
+
+    async def invoke(self, ctx, command, options, interaction):
         params = []
         kwargs = {}
         for name, param in command.clean_params.items():
@@ -1,11 +1,11 @@
+import re
 import time
 import random
+import asyncio
 import discord
 
-from collections import defaultdict
-
-from discord.ext import commands
-from helpers import constants, models, checks
+from discord.ext import commands, tasks
+from helpers import constants, models, checks, misc
 
 
 class Spawning(commands.Cog):
@@ -19,15 +19,134 @@ class Spawning(commands.Cog):
                 pokemon=None, count=0, goal=random.randint(25, 50), timestamp=None
             )
 
-        self.spawns = defaultdict(default_spawn)
-        self.cooldown = {}
+        self.spawns = misc.ExpiringDefaultDict(default_spawn, 100000)
+        self.cooldown = misc.Cooldown(0.5)
+        # prefix -> regex matching it or a mention of the bot at the start of a message
+        self.prefix_matchers = {}
+        # channel ids whose spawn state changed since the last snapshot
+        self.changed_spawns = set()
+        # user id -> selected pokemon and the xp it gained that is not yet written
+        # to the database. The gain is added to the row rather than overwriting
+        # it, other processes may be buffering xp for the same pokemon
+        self.xp = {}
+        self.flush_xp_loop.start()
+        self.prune_spawns.start()
+        self.snapshot_spawns_loop.start()
+        self.bot.loop.create_task(self.restore_spawns())
+
+    def cog_unload(self):
+        self.flush_xp_loop.cancel()
+        self.prune_spawns.cancel()
+        self.snapshot_spawns_loop.cancel()
+        self.bot.loop.create_task(self.flush_xp())
+        # the reloaded cog waits for this before restoring
+        self.bot.spawn_snapshot = self.bot.loop.create_task(self.snapshot_spawns())
+
+    @tasks.loop(minutes=10)
+    async def prune_spawns(self):
+        # channels quiet for a day lose their progress, unless a pokemon is waiting
+        self.spawns.prune(60 * 60 * 24, keep=lambda spawn: spawn["pokemon"])
+        try:
+            await self.bot.db.delete_stale_spawns(60 * 60 * 24)
+        except Exception as error:
+            self.bot.logger.warning("Spawn Prune Failed", extra={"error": repr(error)})
+
+    @tasks.loop(seconds=60)
+    async def snapshot_spawns_loop(self):
+        # the changed channels are kept on failure and written by the next run
+        try:
+            await self.snapshot_spawns()
+        except Exception as error:
+            self.bot.logger.warning(
+                "Spawn Snapshot Failed", extra={"error": repr(error)}
+            )
+
+    async def snapshot_spawns(self):
+        """Write the spawn state of every channel that changed since the last snapshot"""
+        changed, self.changed_spawns = self.changed_spawns, set()
+        states = {id: self.spawns.get(id) for id in changed}
+        states = {id: state for id, state in states.items() if state}
+        if not states:
+            return
+        try:
+            await self.bot.db.save_spawns(states)
+        except Exception:
+            self.changed_spawns |= changed
+            raise
+
+    async def restore_spawns(self):
+        if task := getattr(self.bot, "spawn_snapshot", None):
+            await asyncio.wait([task])
+        for record in await self.bot.db.get_spawns():
+            if record["channel_id"] in self.spawns:
+                continue
+            self.spawns[record["channel_id"]].update(
+                pokemon=self.bot.data.get_species_by_id(record["species_id"]),
+                count=record["count"],
+                goal=record["goal"],
+                timestamp=time.perf_counter(),
+            )
 
-    def random_pokemon(self):
-        pokemon = list(self.bot.data.data.values())
-        pokemon = random.choices(
-            pokemon, weights=[x.get("abundance", 0) for x in pokemon], k=1
-        )[0]
-        return pokemon
+    @tasks.loop(seconds=30)
+    async def flush_xp_loop(self):
+        # an error must not stop the loop, the xp stays buffered for the next run
+        try:
+            await self.flush_xp()
+        except Exception as error:
+            self.bot.logger.warning("XP Flush Failed", extra={"error": repr(error)})
+
+    @commands.Cog.listener()
+    async def on_settings_invalidate(self, table, id):
+        # the user's selected pokemon may have changed in another process
+        if table == "users" and id in self.xp:
+            await self.flush_xp(id)
+
+    async def flush_xp(self, user_id=None):
+        """Write buffered xp to the database, if a user is given only their entry is flushed and dropped"""
+        if user_id is None:
+            # entries that had nothing to write since the last flush are idle
+            for id in [id for id, entry in self.xp.items() if not entry["gain"]]:
+                del self.xp[id]
+            await self.write_xp(list(self.xp.values()))
+            return
+
+        # the entry stays buffered until its xp is written, so messages sent
+        # meanwhile add to it instead of reloading the old row
+        while (entry := self.xp.get(user_id)) and entry["gain"]:
+            await self.write_xp([entry])
+        if entry and self.xp.get(user_id) is entry:
+            del self.xp[user_id]
+
+    async def write_xp(self, entries):
+        if not entries:
+            return
+        gains = [entry["gain"] for entry in entries]
+        for entry in entries:
+            entry["gain"] = 0
+        try:
+            rows = await self.bot.db.add_pokemon_xp(
+                [
+                    (entry["pokemon"].user_id, entry["pokemon"].idx, gain)
+                    for entry, gain in zip(entries, gains)
+                ]
+            )
+        except Exception:
+            for entry, gain in zip(entries, gains):
+                entry["gain"] += gain
+            raise
+
+        # take in xp other processes added, unless more was gained here meanwhile
+        rows = {(row["user_id"], row["idx"]): row for row in rows}
+        for entry in entries:
+            pokemon = entry["pokemon"]
+            if entry["gain"] or not (row := rows.get((pokemon.user_id, pokemon.idx))):
+                continue
+            pokemon.species_id = row["species_id"]
+            pokemon.level = row["level"]
+            pokemon.xp = row["xp"]
+
+    def random_pokemon(self, overrides=None):
+        return self.bot.data.spawn_table(overrides).choice()
 
     async def spawn_pokemon(
         self, channel, pokemon=None, *, guild=None, connection=None
@@ -37,14 +156,17 @@ class Spawning(commands.Cog):
         dummy_message.channel = channel
         dummy_ctx.message = dummy_message
         self.hint.reset_cooldown(dummy_ctx)
+
+        self.changed_spawns.add(channel.id)
+        if (
+            channel.id in self.bot.db.spawns_disabled
+            or channel.id in self.bot.db.commands_disabled
+        ):
+            self.spawns[channel.id]["count"] = 0
+            return
         if not guild:
             guild = await self.bot.db.get_guild(channel.guild, connection=connection)
 
-        if c := await self.bot.db.get_channel(channel):
-            if c.spawns_disabled or c.disabled:
-                self.spawns[channel.id]["count"] = 0
-                return
-
         pokemon = (
             self.bot.data.get_species_by_name(pokemon)
             if pokemon
@@ -54,9 +176,10 @@ class Spawning(commands.Cog):
         self.spawns[channel.id]["count"] = 0
         self.spawns[channel.id]["goal"] = random.randint(25, 50)
         self.spawns[channel.id]["timestamp"] = time.perf_counter()
+        prefix = self.bot.get_cog("Meta").get_prefix(channel.guild)
         embed = constants.Embed(
             title="A wild pokemon as appeared!",
-            description=f"Guess the pokémon's name and type `{await self.bot.get_cog('Meta').get_prefix(channel.guild)}catch <pokemon>` to catch it!",
+            description=f"Guess the pokémon's name and type `{prefix}catch <pokemon>` to catch it!",
         )
         embed.compact_image(guild, url=self.bot.data.image(pokemon["species_id"]))
 
@@ -67,7 +190,7 @@ class Spawning(commands.Cog):
     @commands.max_concurrency(1, commands.BucketType.channel)
     async def catch(self, ctx, *, pokemon):
         """Catch a pokemon!"""
-        pokemon = self.bot.data.get_species_by_name(pokemon)
+        pokemon = self.bot.data.get_species_by_name(pokemon, fuzzy=True)
         if not pokemon:
             return await ctx.send("That's not a pokémon!")
 
@@ -97,38 +220,22 @@ class Spawning(commands.Cog):
                 f"Pokemon caught in {time.perf_counter() - self.spawns[ctx.channel.id]['timestamp']} seconds"
             )
         self.spawns[ctx.channel.id]["pokemon"] = None
+        self.changed_spawns.add(ctx.channel.id)
 
         percentage = 1 / 4096  # in future make changable
         shiny = random.random() <= percentage
 
-        async with self.bot.connection.acquire() as connection:
-            async with connection.transaction():
-                poke = await self.bot.db.insert_pokemon(
-                    ctx.author, pokemon["species_id"], shiny=shiny
-                )
-
-                count = await connection.fetchval(
-                    "INSERT INTO dex(user_id, species_id, count)"
-                    "VALUES($1, $2, 1) ON CONFLICT(user_id, species_id)"
-                    "DO UPDATE SET count = dex.count+1"
-                    "RETURNING count",
-                    ctx.author.id,
-                    pokemon["species_id"],
-                )
+        poke, count, credits = await self.bot.db.catch_pokemon(
+            ctx.author, pokemon["species_id"], shiny=shiny
+        )
 
-                message = f"Congratulations {ctx.author.mention}! You caught a level {poke.level} {'✨' if shiny else ''}{poke.name}!"
-                if count == 1:
-                    message += " Added to pokédex. You've recieved 35 credits!"
-                    await connection.execute(
-                        "UPDATE users SET bal = bal + 35 WHERE id = $1", ctx.author.id
-                    )
-                elif count in (10, 100, 1000):
-                    message += f" You've caught {count} of this pokémon! You've recieved {35*count} credits!"
-                    await connection.execute(
-                        "UPDATE users SET bal = bal + (35 * $2) WHERE id = $1",
-                        ctx.author.id,
-                        count,
-                    )
+        message = f"Congratulations {ctx.author.mention}! You caught a level {poke.level} {'✨' if shiny else ''}{poke.name}!"
+        if count == 1:
+            message += f" Added to pokédex. You've recieved {credits} credits!"
+        elif credits:
+            message += f" You've caught {count} of this pokémon! You've recieved {credits} credits!"
+        if credits:
+            await self.bot.db.invalidate("users", ctx.author, refresh=False)
         await ctx.send(message)
 
     @commands.command()
@@ -149,16 +256,27 @@ class Spawning(commands.Cog):
         await ctx.send(f"The wild pokemon is: {hint}")
 
     async def calculate_xp(self, message, *, connection=None):
-        connection = connection or self.bot.db.connection
-        user = await self.bot.db.get_user(message.author, connection=connection)
-        if not user:
-            return
-        pokemon = models.Pokemon(
-            await self.bot.db.get_pokemon_by_idx(
+        entry = self.xp.get(message.author.id)
+        if not entry:
+            db = self.bot.db
+            if db.loaded and message.author.id not in db.started:
+                return
+            connection = connection or self.bot.db.connection
+            user = await self.bot.db.get_user(message.author, connection=connection)
+            if not user:
+                return
+            record = await self.bot.db.get_pokemon_by_idx(
                 message.author, user.selected, connection=connection
-            ),
-            self.bot.data,
-        )
+            )
+            if not record:
+                return
+            entry = self.xp[message.author.id] = dict(
+                pokemon=models.Pokemon(record, self.bot.data),
+                hide_levelup=user.hide_levelup,
+                gain=0,
+            )
+
+        pokemon = entry["pokemon"]
         if pokemon.item == "XP Blocker":
             return
         if pokemon.level == 100:
@@ -167,12 +285,13 @@ class Spawning(commands.Cog):
         xp = random.randint(10, 40)
 
         pokemon.xp += xp
+        entry["gain"] += xp
 
         if pokemon.xp >= pokemon.xp_needed:
             embed = constants.Embed(
                 title=f"Congratulations {message.author.display_name}!"
             )
-            while pokemon.xp >= pokemon.xp_needed:
+            while pokemon.xp >= pokemon.xp_needed and pokemon.level < 100:
                 pokemon.xp -= pokemon.xp_needed
                 pokemon.level += 1
             embed.description = f"Your {pokemon.name} is now level {pokemon.level}!"
@@ -186,49 +305,42 @@ class Spawning(commands.Cog):
                     value=f"Your {oldname} evolved into {pokemon.name}!",
                 )
 
-            if not user.hide_levelup:
+            if not entry["hide_levelup"]:
                 await message.channel.send(embed=embed)
 
-        await self.bot.db.update_pokemon_by_idx(
-            message.author,
-            user.selected,
-            dict(
-                species_id=pokemon.species_id,
-                xp=pokemon.xp,
-                level=pokemon.level,
-            ),
-            connection=connection,
-        )
+    async def is_command(self, message):
+        """Whether the message invokes a command, only messages starting with a prefix are parsed"""
+        prefix = self.bot.get_cog("Meta").get_prefix(message.guild)
+        if not (matcher := self.prefix_matchers.get(prefix)):
+            matcher = self.prefix_matchers[prefix] = re.compile(
+                rf"<@!?{self.bot.user.id}>|{re.escape(prefix)}"
+            )
+        if not matcher.match(message.content):
+            return False
+        ctx = await self.bot.get_context(message)
+        return ctx.valid
 
     @commands.Cog.listener("on_message")
     async def spawning(self, message):
-        ctx = await self.bot.get_context(message)
-        if ctx.valid:
+        if message.author.bot or not message.guild:
+            return
+        if await self.is_command(message):
             return
 
-        if cd := self.cooldown.get(message.author.id):
-            if time.perf_counter() - cd <= 0.5:
-                return
-        self.cooldown[message.author.id] = time.perf_counter()
+        if self.cooldown.is_on_cooldown(message.author.id):
+            return
         self.spawns[message.channel.id]["count"] += 1
+        self.changed_spawns.add(message.channel.id)
         if (
             self.spawns[message.channel.id]["count"]
             >= self.spawns[message.channel.id]["goal"]
         ):
-            async with self.bot.connection.acquire() as connection:
-                async with connection.transaction():
-                    guild = await self.bot.db.get_guild(
-                        message.guild, connection=connection
-                    )
-                    if not guild or not guild.redirects:
-                        channel = message.channel
-                    else:
-                        channel = message.guild.get_channel(
-                            random.choice(guild.redirects)
-                        )
-                    await self.spawn_pokemon(
-                        channel, guild=guild, connection=connection
-                    )
+            channel = message.channel
+            if redirects := self.bot.db.redirects.get(message.guild.id):
+                channel = message.guild.get_channel(random.choice(redirects)) or channel
+            if channel != message.channel:
+                self.spawns[message.channel.id]["count"] = 0
+            await self.spawn_pokemon(channel)
 
         await self.calculate_xp(message)
 
@@ -5,6 +5,15 @@ from typing import List, NamedTuple
 with open("config.toml") as f:
     config = toml.load(f)
 
+# optional keys of [database] that are passed on to asyncpg.create_pool
+POOL_OPTIONS = (
+    "min_size",
+    "max_size",
+    "command_timeout",
+    "max_inactive_connection_lifetime",
+    "statement_cache_size",
+)
+
 
 class Config(NamedTuple):
     token: int
@@ -14,6 +23,15 @@ class Config(NamedTuple):
     error_log_channel_id: int
     image_server_url: str
     debug: bool
+    pool: dict
+    # seconds to wait for a free connection before giving up, None waits forever
+    acquire_timeout: float
+    # queries slower than this many milliseconds are logged
+    slow_query_ms: float
+    # write logs as JSON lines instead of key=value pairs
+    log_json: bool
+    # message -> fraction of its records to keep, for high volume messages
+    log_sample: dict
 
 
 if config["bot"]["extensions"] == "all":
@@ -31,4 +49,9 @@ config = Config(
     config["bot"]["error_log_channel_id"],
     config["bot"]["image_server_url"],
     config["bot"]["debug"],
+    {key: config["database"][key] for key in POOL_OPTIONS if key in config["database"]},
+    config["database"].get("acquire_timeout"),
+    config["database"].get("slow_query_ms", 100),
+    config.get("logging", {}).get("json", False),
+    config.get("logging", {}).get("sample", {}),
 )
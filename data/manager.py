@@ -1,12 +1,67 @@
+import os
 import json
+import pickle
+import hashlib
 from functools import cached_property
+from data.sampler import AliasSampler
+from data.species import SpeciesTable
+from data.names import NameIndex
+
+JSON_PATH = "data/pokemon.json"
+CACHE_PATH = "data/pokemon.cache"
+# bump when the layout of anything in CACHED changes
+CACHE_VERSION = 2
+# the classes pickled into the cache, a change to them invalidates it too
+CACHE_SOURCES = ("data/species.py", "data/names.py")
+CACHED = ("data", "legendary", "mythical", "ultra_beast", "names", "species")
 
 
 class DataManager:
     def __init__(self, bot=None):
-        with open("data/pokemon.json") as f:
-            self.og_data = json.load(f)
+        with open(JSON_PATH, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw)
+        for path in CACHE_SOURCES:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        self.hash = digest.hexdigest()
         self.bot = bot
+        self._spawn_tables = {}
+        self._dex_orders = {}
+        if not self.load_cache():
+            self.og_data = json.loads(raw)
+            self.build_cache()
+
+    def load_cache(self):
+        """Load the precompiled tables, returns False if there is no cache for this json"""
+        try:
+            with open(CACHE_PATH, "rb") as f:
+                cache = pickle.load(f)
+            if cache["version"] != CACHE_VERSION or cache["hash"] != self.hash:
+                return False
+            tables = cache["tables"]
+        except Exception:
+            # missing, truncated, or pickled from classes which have since changed
+            return False
+
+        # cached properties are stored in the instance dict under their name
+        self.__dict__.update(tables)
+        return True
+
+    def build_cache(self):
+        """Compile the json into a pickle of every cached table, keyed on its sources' hash"""
+        cache = dict(
+            version=CACHE_VERSION,
+            hash=self.hash,
+            tables={name: getattr(self, name) for name in CACHED},
+        )
+        try:
+            with open(f"{CACHE_PATH}.tmp", "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{CACHE_PATH}.tmp", CACHE_PATH)
+        except OSError:
+            # a read only checkout can still run from the json
+            pass
 
     def image(self, species_id, shiny=False):
         if self.bot:
@@ -20,6 +75,10 @@ class DataManager:
             mapping[int(id)] = poke
         return mapping
 
+    @cached_property
+    def species(self):
+        return SpeciesTable(self.data)
+
     @cached_property
     def legendary(self):
         return {
@@ -45,18 +104,54 @@ class DataManager:
         }
 
     @cached_property
-    def name_to_species(self):
-        mapping = {}
-        for id, poke in self.data.items():
-            mapping[poke["name"]] = poke
-            if jp := poke.get("japanese"):
-                mapping[jp.lower()] = poke
-            if kana := poke.get("kana"):
-                mapping[kana] = poke
-        return mapping
+    def names(self):
+        return NameIndex(self.data)
 
-    def get_species_by_name(self, name):
-        return self.name_to_species.get(name)
+    def spawn_table(self, overrides=None):
+        """The spawn sampler, overrides maps a rarity or species id to a weight multiplier
+
+        A table is built once per distinct set of overrides and reused after that
+        """
+        key = frozenset(overrides.items()) if overrides else None
+        if (table := self._spawn_tables.get(key)) is not None:
+            return table
+
+        overrides = overrides or {}
+        pokemon = list(self.data.values())
+        weights = []
+        for poke in pokemon:
+            weight = poke.get("abundance", 0)
+            weight *= overrides.get(poke.get("rarity"), 1)
+            weight *= overrides.get(poke["species_id"], 1)
+            weights.append(weight)
+
+        table = self._spawn_tables[key] = AliasSampler(pokemon, weights)
+        return table
+
+    def dex_order(self, rarity=None):
+        """Species ids by id, of every species or only those of a rarity"""
+        if (order := self._dex_orders.get(rarity)) is None:
+            if rarity is None:
+                ids = self.species.ids
+            else:
+                ids = self.species.with_rarity(rarity)
+            order = self._dex_orders[rarity] = tuple(ids)
+        return order
+
+    def get_species_by_name(self, name, *, fuzzy=False):
+        """Get a species by any of its names, with fuzzy a close typo is accepted too"""
+        if poke := self.names.get(name):
+            return poke
+        if fuzzy and (matches := self.names.fuzzy(name)):
+            return matches[0]
+        return None
+
+    def search_species(self, name, limit=25):
+        return self.names.search(name, limit)
 
     def get_species_by_id(self, id):
         return self.data.get(id)
+
+
+if __name__ == "__main__":
+    DataManager().build_cache()
@@ -0,0 +1,133 @@
+import bisect
+import unicodedata
+from collections import Counter
+
+
+def normalize(name):
+    """Fold a name to the form it is indexed by
+
+    Case, latin accents, spacing and punctuation are ignored so "Mr. Mime",
+    "mr mime" and "MrMime" are the same name. Kana keep their voicing marks.
+    """
+    name = unicodedata.normalize("NFKC", name).casefold()
+    folded = []
+    for char in name:
+        if ord(char) < 0x250:
+            char = "".join(
+                c
+                for c in unicodedata.normalize("NFKD", char)
+                if not unicodedata.combining(c)
+            )
+        if char.isalnum() or char in "♀♂?!":
+            folded.append(char)
+    return "".join(folded)
+
+
+def trigrams(key):
+    key = f"  {key} "
+    return {key[i : i + 3] for i in range(len(key) - 2)}
+
+
+def distance(a, b, bound):
+    """Levenshtein distance between a and b, or bound + 1 if it is over bound"""
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    over = bound + 1
+    if not a or not b:
+        return min(len(a) + len(b), over)
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        # cells further than bound from the diagonal can't be within bound
+        low = max(1, i - bound)
+        high = min(len(b), i + bound)
+        current = [over] * (len(b) + 1)
+        current[0] = i
+        for j in range(low, high + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char != b[j - 1]),
+            )
+        if min(current[low : high + 1]) > bound:
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+
+class NameIndex:
+    """Exact, prefix and fuzzy lookups over every name of every species"""
+
+    def __init__(self, data):
+        self.exact = {}
+        # a species' own name wins over another form's alias of the same name
+        for poke in data.values():
+            self.exact.setdefault(normalize(poke["name"]), poke)
+        for poke in data.values():
+            for name in (poke.get("english"), poke.get("japanese"), poke.get("kana")):
+                if name and (key := normalize(name)):
+                    self.exact.setdefault(key, poke)
+
+        self.keys = sorted(self.exact)
+        self.trigrams = {}
+        for index, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                self.trigrams.setdefault(gram, []).append(index)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, name):
+        return self.exact.get(normalize(name))
+
+    def prefix(self, name, limit=25):
+        """Species with a name starting with `name`, shortest name first"""
+        key = normalize(name)
+        start = bisect.bisect_left(self.keys, key)
+        found = {}
+        for other in self.keys[start:]:
+            if not other.startswith(key):
+                break
+            poke = self.exact[other]
+            if len(other) < found.get(poke["species_id"], (999,))[0]:
+                found[poke["species_id"]] = (len(other), poke)
+        return [poke for _, poke in sorted(found.values(), key=lambda x: x[0])[:limit]]
+
+    def fuzzy(self, name, max_distance=None, limit=1):
+        """Species whose name is within `max_distance` edits of `name`, closest first"""
+        key = normalize(name)
+        if not key:
+            return []
+        if max_distance is None:
+            max_distance = 1 if len(key) <= 5 else 2
+
+        # an edit changes at most three trigrams, so names sharing fewer than
+        # this can't be close enough and are skipped without an edit distance
+        grams = trigrams(key)
+        needed = len(grams) - 3 * max_distance
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.trigrams.get(gram, ()))
+
+        found = {}
+        for index, count in shared.most_common(50):
+            if count < needed:
+                break
+            other = self.keys[index]
+            if (dist := distance(key, other, max_distance)) > max_distance:
+                continue
+            poke = self.exact[other]
+            if dist < found.get(poke["species_id"], (max_distance + 1,))[0]:
+                found[poke["species_id"]] = (dist, poke)
+        return [poke for _, poke in sorted(found.values(), key=lambda x: x[0])[:limit]]
+
+    def search(self, name, limit=25):
+        """Prefix matches topped up with fuzzy matches, for autocompletion"""
+        results = self.prefix(name, limit)
+        if len(results) < limit:
+            seen = {poke["species_id"] for poke in results}
+            results.extend(
+                poke
+                for poke in self.fuzzy(name, limit=limit)
+                if poke["species_id"] not in seen
+            )
+        return results[:limit]
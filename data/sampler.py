@@ -0,0 +1,52 @@
+import random
+
+
+class AliasSampler:
+    """Weighted sampling in O(1) per draw using Vose's alias method"""
+
+    def __init__(self, items, weights):
+        items = list(items)
+        weights = [float(weight) for weight in weights]
+        total = sum(weights)
+        if not items or total <= 0:
+            raise ValueError("Cannot sample from an empty or zero weight population")
+
+        size = len(items)
+        scaled = [weight * size / total for weight in weights]
+        prob = [0.0] * size
+        alias = list(range(size))
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+        # anything left over is only off from 1 by floating point error
+        for i in large + small:
+            prob[i] = 1.0
+
+        self.items = items
+        self.weights = weights
+        self.total = total
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.items)
+
+    def probability(self, index):
+        return self.weights[index] / self.total
+
+    def choice(self, rng=random):
+        index = int(rng.random() * len(self.items))
+        if rng.random() < self.prob[index]:
+            return self.items[index]
+        return self.items[self.alias[index]]
+
+    def sample(self, k, rng=random):
+        return [self.choice(rng) for _ in range(k)]
@@ -0,0 +1,60 @@
+from array import array
+
+# the order of stats everywhere in the table, matches the iv columns of pokemon
+STATS = ("hp", "attack", "defense", "special_attack", "special_defense", "speed")
+RARITIES = (None, "legendary", "mythical", "ultra_beast")
+
+
+class SpeciesTable:
+    """Species data stored column wise in flat arrays indexed by species id
+
+    Ids that are not a species (form ids are sparse) have zeroed rows
+    """
+
+    def __init__(self, data):
+        self.ids = array("I", sorted(data))
+        self.size = max(data) + 1
+        self.base = {stat: array("H", [0]) * self.size for stat in STATS}
+        self.abundance = array("I", [0]) * self.size
+        self.rarity = array("B", [0]) * self.size
+        # 0 means the species does not evolve
+        self.evolution = array("H", [0]) * self.size
+        self.evolution_level = array("B", [0]) * self.size
+
+        for species_id, poke in data.items():
+            for stat in STATS:
+                self.base[stat][species_id] = poke[stat]
+            self.abundance[species_id] = poke.get("abundance", 0)
+            self.rarity[species_id] = RARITIES.index(poke.get("rarity"))
+            self.evolution[species_id] = poke.get("evolution") or 0
+            self.evolution_level[species_id] = poke.get("evolution_level") or 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def with_rarity(self, rarity):
+        code = RARITIES.index(rarity)
+        return [
+            species_id for species_id in self.ids if self.rarity[species_id] == code
+        ]
+
+    def compute_stats(self, species_ids, levels, ivs):
+        """Compute the six stats of many pokemon at once
+
+        `ivs` holds a (hp, atk, def, spatk, spdef, spd) sequence for each pokemon,
+        a tuple of the six stats in the same order is returned for each pokemon
+        """
+        hp, attack, defense, special_attack, special_defense, speed = (
+            self.base[stat] for stat in STATS
+        )
+        return [
+            (
+                (2 * hp[species_id] + iv[0]) * level // 100 + level + 10,
+                (2 * attack[species_id] + iv[1]) * level // 100 + 5,
+                (2 * defense[species_id] + iv[2]) * level // 100 + 5,
+                (2 * special_attack[species_id] + iv[3]) * level // 100 + 5,
+                (2 * special_defense[species_id] + iv[4]) * level // 100 + 5,
+                (2 * speed[species_id] + iv[5]) * level // 100 + 5,
+            )
+            for species_id, level, iv in zip(species_ids, levels, ivs)
+        ]
@@ -2,18 +2,26 @@ from discord.ext.commands import check, CheckFailure
 
 
 def has_started():
-    """Checks that the user has started, this also doubles as the blacklist check"""
+    """Checks that the user has started, this also doubles as the blacklist check
+
+    The user is attached to the context as `ctx.user` for the command to reuse
+    """
 
     async def predicate(ctx):
-        disabled = await ctx.bot.connection.fetchval(
-            "SELECT disabled FROM users WHERE id = $1", ctx.author.id
-        )
+        db = ctx.bot.db
+        if db.loaded:
+            if ctx.author.id not in db.started:
+                raise CheckFailure("You have not started yet! Please start first!")
+            if ctx.author.id in db.suspended:
+                raise CheckFailure("Your account has been disabled.")
 
-        if disabled:
+        user = await ctx.user_row
+        if user is None:
+            raise CheckFailure("You have not started yet! Please start first!")
+        if user.disabled:
             raise CheckFailure("Your account has been disabled.")
-        elif disabled is not None:
-            return True
 
-        raise CheckFailure("You have not started yet! Please start first!")
+        ctx.user = user
+        return True
 
     return check(predicate)
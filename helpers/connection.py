@@ -0,0 +1,224 @@
+import re
+import time
+import bisect
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+import asyncpg
+from collections import deque, OrderedDict
+from helpers.queries import QUERIES
+
+logger = logging.getLogger("discord")
+
+# the context of the command being run by the current task
+current_context = contextvars.ContextVar("current_context", default=None)
+# upper bounds in seconds of the buckets acquire wait times are counted in
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, float("inf"))
+
+
+class PoolStats:
+    """Acquire wait times, connections in use and recent query latencies of the pool"""
+
+    def __init__(self, samples=10000):
+        self.waits = [0] * len(WAIT_BUCKETS)
+        self.in_use = 0
+        self.max_in_use = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=samples)
+
+    def acquired(self, wait):
+        self.waits[bisect.bisect_left(WAIT_BUCKETS, wait)] += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def released(self):
+        self.in_use -= 1
+
+    def percentiles(self, *percents):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return [0.0 for _ in percents]
+        return [
+            latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+            for percent in percents
+        ]
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(query):
+    """The shape of a query, literals replaced and whitespace collapsed"""
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"(?<![$\w])\d+(\.\d+)?\b", "?", query)
+    query = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", query)
+    return " ".join(query.split())
+
+
+class QueryShape:
+    def __init__(self, params, samples):
+        self.params = params
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.commands = set()
+        self.latencies = deque(maxlen=samples)
+
+    def percentile(self, percent):
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+
+class QueryStats:
+    """Rolling aggregates per query shape, and a log of queries slower than `slow`"""
+
+    def __init__(self, slow=0.1, maxsize=500, samples=256):
+        self.slow = slow
+        self.maxsize = maxsize
+        self.samples = samples
+        self.shapes = OrderedDict()
+
+    def record(self, query, latency, command):
+        shape = normalize(query)
+        if (aggregate := self.shapes.get(shape)) is None:
+            params = len(set(re.findall(r"\$(\d+)", shape)))
+            aggregate = self.shapes[shape] = QueryShape(params, self.samples)
+            if len(self.shapes) > self.maxsize:
+                self.shapes.popitem(last=False)
+        self.shapes.move_to_end(shape)
+        aggregate.calls += 1
+        aggregate.total += latency
+        aggregate.max = max(aggregate.max, latency)
+        aggregate.latencies.append(latency)
+        if command:
+            aggregate.commands.add(command)
+
+        if latency >= self.slow:
+            logger.warning(
+                "Slow Query",
+                extra={
+                    "query": shape,
+                    "params": aggregate.params,
+                    "ms": round(latency * 1000, 2),
+                    "command": command,
+                },
+            )
+
+
+stats = PoolStats()
+queries = QueryStats()
+
+
+async def init(connection):
+    await connection.prepare_statements()
+
+
+class Connection(asyncpg.Connection):
+    """A connection which counts and times its round trips"""
+
+    async def prepare_statements(self):
+        self.statements = {}
+        for name, query in QUERIES.items():
+            self.statements[name] = await self.prepare(query)
+
+    async def run_prepared(self, name, method, *args):
+        """Run a registered query with the statement prepared for it on this connection"""
+        with self.round_trip(QUERIES[name]):
+            try:
+                return await getattr(self.statements[name], method)(*args)
+            except (
+                asyncpg.InvalidCachedStatementError,
+                asyncpg.OutdatedSchemaCacheError,
+            ):
+                # the schema changed under the statement, prepare it again
+                self.statements[name] = await self.prepare(QUERIES[name])
+                return await getattr(self.statements[name], method)(*args)
+
+    @contextlib.contextmanager
+    def round_trip(self, query):
+        command = None
+        if (ctx := current_context.get()) is not None:
+            ctx.round_trips += 1
+            command = ctx.command and ctx.command.qualified_name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            latency = time.perf_counter() - start
+            stats.latencies.append(latency)
+            queries.record(query, latency, command)
+
+    async def execute(self, query, *args, **kwargs):
+        with self.round_trip(query):
+            return await super().execute(query, *args, **kwargs)
+
+    async def executemany(self, query, *args, **kwargs):
+        with self.round_trip(query):
+            return await super().executemany(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        with self.round_trip(query):
+            return await super().fetch(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        with self.round_trip(query):
+            return await super().fetchval(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        with self.round_trip(query):
+            return await super().fetchrow(query, *args, **kwargs)
+
+
+class Acquire:
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.connection = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            self.connection = await self.pool.pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            raise
+        stats.acquired(time.perf_counter() - start)
+        return self.connection
+
+    async def __aexit__(self, *exc_info):
+        stats.released()
+        await self.pool.pool.release(self.connection)
+
+
+class Pool:
+    """Wraps the asyncpg pool so the time spent waiting for a connection is recorded"""
+
+    def __init__(self, pool, acquire_timeout=None):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def acquire(self, *, timeout=None):
+        return Acquire(self, timeout or self.acquire_timeout)
+
+    async def execute(self, *args, **kwargs):
+        async with self.acquire() as connection:
+            return await connection.execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        async with self.acquire() as connection:
+            return await connection.executemany(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        async with self.acquire() as connection:
+            return await connection.fetch(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        async with self.acquire() as connection:
+            return await connection.fetchval(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        async with self.acquire() as connection:
+            return await connection.fetchrow(*args, **kwargs)
@@ -17,7 +17,9 @@ CREATE TABLE users(
     last_voted TIMESTAMP DEFAULT NULL,
     total_votes INT DEFAULT 0,
     --settings
-    hide_levelup BOOL DEFAULT FALSE
+    hide_levelup BOOL DEFAULT FALSE,
+    --the idx the next pokemon caught will get
+    next_idx INT NOT NULL DEFAULT 1
 );
 CREATE TABLE guilds(
     id BIGINT PRIMARY KEY,
@@ -71,7 +73,17 @@ CREATE TABLE pokemon(
     
     PRIMARY KEY(user_id, idx)
 );
+CREATE TABLE spawns(
+    channel_id BIGINT PRIMARY KEY,
+    species_id INT DEFAULT NULL,
+    count INT NOT NULL,
+    goal INT NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
 
 
 CREATE INDEX pokemon_idx ON pokemon(idx);
 CREATE INDEX pokemon_id ON pokemon(id);
+CREATE INDEX pokemon_user_level ON pokemon(user_id, level, idx) WHERE market_price IS NULL;
+CREATE INDEX pokemon_user_total_iv ON pokemon(user_id, total_iv, idx) WHERE market_price IS NULL;
+CREATE INDEX pokemon_user_species_id ON pokemon(user_id, species_id, idx) WHERE market_price IS NULL;
@@ -1,7 +1,36 @@
 from discord.ext import commands
 
 
-class PokeContext(commands.Context):
+class RowsMixin:
+    """Settings rows loaded on first use and shared for the rest of the invocation"""
+
+    rows = None
+    # set by checks.has_started
+    user = None
+    # database round trips made while running the command
+    round_trips = 0
+
+    async def fetch_rows(self):
+        if self.rows is None:
+            self.rows = await self.bot.db.get_rows(
+                self.author, self.guild, self.channel
+            )
+        return self.rows
+
+    @property
+    async def user_row(self):
+        return (await self.fetch_rows())[0]
+
+    @property
+    async def guild_row(self):
+        return (await self.fetch_rows())[1]
+
+    @property
+    async def channel_row(self):
+        return (await self.fetch_rows())[2]
+
+
+class PokeContext(RowsMixin, commands.Context):
     pass
 
 
@@ -5,25 +5,20 @@ from helpers.models import Pokemon
 
 class PokemonConverter(commands.Converter):
     async def convert(self, ctx, argument):
+        if spawning := ctx.bot.get_cog("Spawning"):
+            await spawning.flush_xp(ctx.author.id)
         if not argument:
-            argument = await ctx.bot.connection.fetchval(
-                "SELECT selected FROM users WHERE id = $1", ctx.author.id
-            )
+            argument = (await ctx.user_row).selected
         elif argument.lower() in ("l", "latest"):
             argument = 0
         elif not is_int(argument):
             raise commands.BadArgument("Please specify an id or latest")
         else:
             argument = int(argument)
-        async with ctx.bot.connection.acquire() as conn:
-            async with conn.transaction():
-                count = await ctx.bot.db.get_next_idx(ctx.author, connection=conn)
-                count -= 1
-                if argument < 1:
-                    argument = count - argument
-                pokemon = await ctx.bot.db.get_pokemon_by_idx(
-                    ctx.author, argument, connection=conn
-                )
+        if argument < 1:
+            pokemon = await ctx.bot.db.get_latest_pokemon(ctx.author, -argument)
+        else:
+            pokemon = await ctx.bot.db.get_pokemon_by_idx(ctx.author, argument)
 
         if not pokemon:
             raise commands.BadArgument("No pokemon found with that id")
@@ -41,7 +36,11 @@ class DexConverter(commands.Converter):
             if pokemon := ctx.bot.data.get_species_by_id(int(argument[1:])):
                 return pokemon, shiny
 
-        elif pokemon := ctx.bot.data.get_species_by_name(argument):
+        # page numbers and flags for the pokedex listing must not be fuzzy matched
+        elif pokemon := ctx.bot.data.get_species_by_name(
+            argument,
+            fuzzy=not argument.startswith("-") and not is_int(argument.split(" ")[0]),
+        ):
             return pokemon, shiny
 
         raise commands.BadArgument(f"No dex entry found for {argument}")
@@ -1,9 +1,98 @@
+import time
 import asyncpg
 import random
-from helpers import constants, models
-from collections import defaultdict
+import secrets
+from helpers import constants, models, misc
+from helpers.connection import Pool
+from collections import defaultdict, OrderedDict
 from discord.ext import commands
 
+SETTINGS_CHANNEL = "pokeland_settings"
+MISSING = object()
+# the model each cached settings table is loaded as
+MODELS = {"users": models.User, "guilds": models.Guild, "channels": models.Channel}
+# the columns a user can order their pokemon by, each is backed by a
+# (user_id, column, idx) index so pages can be found with a keyset seek
+ORDERINGS = ("idx", "level", "total_iv", "species_id")
+
+
+class SettingsCache:
+    """A bounded LRU cache of settings rows which expire after `ttl` seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # bumped on every invalidation so reads that raced one are not stored
+        self.version = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, id):
+        entry = self.entries.get(id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(id)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, id, value, version=None):
+        if version is not None and version != self.version:
+            return
+        self.entries[id] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, id):
+        self.version += 1
+        self.entries.pop(id, None)
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+
+
+class PrefixMap:
+    """Custom prefixes by guild id, a guild missing from a complete map uses the default
+
+    Past `maxsize` guilds only the most recently used are kept and the map is no
+    longer complete, a lookup of an unknown guild then returns MISSING
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.prefixes = OrderedDict()
+        self.complete = False
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def load(self, prefixes):
+        self.prefixes = OrderedDict(list(prefixes.items())[: self.maxsize])
+        self.complete = len(prefixes) <= self.maxsize
+
+    def get(self, id):
+        if (prefix := self.prefixes.get(id, MISSING)) is not MISSING:
+            self.prefixes.move_to_end(id)
+            return prefix
+        return None if self.complete else MISSING
+
+    def set(self, id, prefix):
+        if prefix is None and self.complete:
+            self.prefixes.pop(id, None)
+            return
+        # an incomplete map also remembers the guilds known to use the default
+        self.prefixes[id] = prefix
+        self.prefixes.move_to_end(id)
+        if len(self.prefixes) > self.maxsize:
+            self.prefixes.popitem(last=False)
+            self.complete = False
+
 
 class Database(commands.Cog):
     """The cog for interfacting with the database"""
@@ -11,10 +100,162 @@ class Database(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.connection = bot.connection
+        self.caches = {
+            "users": SettingsCache(50000, 60),
+            "guilds": SettingsCache(10000, 300),
+            "channels": SettingsCache(50000, 300),
+        }
+        # kept up to date by catches in this process, the ttl bounds how stale
+        # catches made in other processes can make an entry
+        self.dexes = SettingsCache(10000, 120)
+        # user id -> (ordering, filters) -> the sort key of the last pokemon on
+        # each page viewed and the total, so the next page of the pokemon listing
+        # can seek instead of scanning. Dropped whenever the user's pokemon change
+        self.cursors = OrderedDict()
+        # channel and guild settings needed on every message, kept fully in memory
+        self.spawns_disabled = set()
+        self.commands_disabled = set()
+        self.redirects = {}
+        self.prefixes = PrefixMap(100000)
+        # commands checked against commands_disabled, and those checked before
+        # it was loaded which needed the channel's row
+        self.channel_checks = 0
+        self.channel_fallbacks = 0
+        # who has started and who is suspended, checked before every gated command
+        self.started = misc.IntSet()
+        self.suspended = misc.IntSet()
+        self.loaded = False
+        self.listener = None
+        # sent with our notifications so we can ignore them when they come back
+        self.token = secrets.token_hex(8)
+        self.bot.loop.create_task(self.listen())
+        self.bot.loop.create_task(self.load_settings())
+
+    def cog_unload(self):
+        if self.listener:
+            self.bot.loop.create_task(self.listener.close())
+            self.listener = None
+
+    async def listen(self):
+        """Listen for settings changes made by any process to evict stale cache entries"""
+        self.listener = await asyncpg.connect(self.bot.config.db_string)
+        self.listener.add_termination_listener(self.on_listener_terminated)
+        await self.listener.add_listener(SETTINGS_CHANNEL, self.on_settings_changed)
+
+    def on_listener_terminated(self, connection):
+        if connection is not self.listener:
+            return
+        # we may have missed notifications while disconnected
+        for cache in self.caches.values():
+            cache.clear()
+        self.bot.loop.create_task(self.listen())
+        self.bot.loop.create_task(self.load_settings())
+
+    def on_settings_changed(self, connection, pid, channel, payload):
+        table, id, refresh, token = payload.split(":")
+        if token == self.token or table not in self.caches:
+            return
+        self.caches[table].invalidate(int(id))
+        if refresh == "1":
+            self.bot.loop.create_task(self.refresh_settings(table, int(id)))
+        self.bot.dispatch("settings_invalidate", table, int(id))
+
+    async def load_settings(self):
+        """Load every disabled channel, customised guild and started user in bulk"""
+        users = await self.connection.fetch("SELECT id, disabled FROM users")
+        channels = await self.connection.fetch(
+            "SELECT id, spawns_disabled, disabled FROM channels WHERE spawns_disabled OR disabled"
+        )
+        guilds = await self.connection.fetch(
+            "SELECT id, redirects, prefix FROM guilds WHERE redirects IS NOT NULL OR prefix IS NOT NULL"
+        )
+        self.spawns_disabled = {c["id"] for c in channels if c["spawns_disabled"]}
+        self.commands_disabled = {c["id"] for c in channels if c["disabled"]}
+        self.redirects = {g["id"]: g["redirects"] for g in guilds if g["redirects"]}
+        self.prefixes.load({g["id"]: g["prefix"] for g in guilds if g["prefix"]})
+        self.started = misc.IntSet(u["id"] for u in users)
+        self.suspended = misc.IntSet(u["id"] for u in users if u["disabled"])
+        self.loaded = True
+
+    async def refresh_settings(self, table, id):
+        """Reload one row of the in memory user, channel and guild settings"""
+        if table == "users":
+            user = await self.get_user(id)
+            for members, flag in (
+                (self.started, user),
+                (self.suspended, user and user.disabled),
+            ):
+                if flag:
+                    members.add(id)
+                else:
+                    members.discard(id)
+        elif table == "channels":
+            channel = await self.get_channel(id)
+            for disabled, flag in (
+                (self.spawns_disabled, channel and channel.spawns_disabled),
+                (self.commands_disabled, channel and channel.disabled),
+            ):
+                if flag:
+                    disabled.add(id)
+                else:
+                    disabled.discard(id)
+        elif table == "guilds":
+            guild = await self.get_guild(id)
+            if guild and guild.redirects:
+                self.redirects[id] = guild.redirects
+            else:
+                self.redirects.pop(id, None)
+            self.prefixes.set(id, (guild and guild.prefix) or None)
+
+    async def invalidate(self, table, id, *, refresh=True, connection=None):
+        """Evict a settings row and tell every other process to do the same
+
+        Call this after the write has been committed. Pass refresh=False when
+        the write can't change the in memory settings, such as a balance update
+        """
+        connection = connection or self.connection
+        id = self.get_id_from_object(id)
+        self.caches[table].invalidate(id)
+        if refresh:
+            await self.refresh_settings(table, id)
+        await connection.execute(
+            "SELECT pg_notify($1, $2)",
+            SETTINGS_CHANNEL,
+            f"{table}:{id}:{int(refresh)}:{self.token}",
+        )
+
+    async def run(self, name, method, *args, connection=None):
+        """Run a query from the registry as its prepared statement"""
+        if connection is None or isinstance(connection, Pool):
+            async with (connection or self.connection).acquire() as connection:
+                return await connection.run_prepared(name, method, *args)
+        return await connection.run_prepared(name, method, *args)
+
+    def get_cursors(self, user_id):
+        cursors = self.cursors.setdefault(user_id, {})
+        self.cursors.move_to_end(user_id)
+        if len(self.cursors) > 1000:
+            self.cursors.popitem(last=False)
+        return cursors
+
+    def forget_cursors(self, *user_ids):
+        for user_id in user_ids:
+            self.cursors.pop(user_id, None)
 
     def random_ivs(self):
         return [random.randint(1, 31) for i in range(6)]
 
+    def random_pokemon_values(self, shiny=False):
+        """The level, xp, nature, shiny, ivs and moves of a newly obtained pokemon"""
+        return [
+            random.randint(1, 25),
+            0,
+            random.choice(constants.NATURES),
+            shiny,
+            *self.random_ivs(),
+            ["Tackle"] * 4,
+        ]
+
     def get_id_from_object(self, object):
         if isinstance(object, int):
             return object
@@ -30,9 +271,8 @@ class Database(commands.Cog):
     def format_query_from_flags(self, flags, start=4):
         filters = defaultdict(list)
         if flags and flags.name:
-            filters["species_id"].append(
-                self.bot.data.get_species_by_name(flags.name)["species_id"]
-            )
+            species = self.bot.data.get_species_by_name(flags.name, fuzzy=True)
+            filters["species_id"].append(species["species_id"] if species else 0)
         if flags and flags.level:
             filters["level"].append(flags.level)
         if flags and flags.legendary:
@@ -51,16 +291,60 @@ class Database(commands.Cog):
             query = ""
             args = []
 
-        print(query)
         return query, args
 
+    def order_columns(self, order_by):
+        if order_by not in ORDERINGS or order_by == "idx":
+            return ["idx"]
+        return [order_by, "idx"]
+
+    async def get_pokemon_page(
+        self,
+        user_id,
+        order_by,
+        *,
+        flags=None,
+        limit=15,
+        offset=0,
+        after=None,
+        with_total=False,
+        connection=None,
+    ):
+        """Fetch a page of a user's pokemon in the order they have chosen
+
+        `after` is the sort key of the last row of an earlier page, given it the
+        page is found by seeking the index instead of counting rows from the start.
+        With `with_total` each row has a `total` column of every matching pokemon
+        """
+        connection = connection or self.connection
+        user_id = self.get_id_from_object(user_id)
+        columns = ", ".join(self.order_columns(order_by))
+        args = [user_id, limit, offset]
+        seek = ""
+        if after:
+            seek = f"AND ({columns}) > ({', '.join(f'${i}' for i in range(4, 4 + len(after)))})"
+            args.extend(after)
+        constraints, constraint_args = self.format_query_from_flags(
+            flags, start=len(args) + 1
+        )
+        args.extend(constraint_args)
+        total = ", count(*) over() AS total" if with_total else ""
+        return await connection.fetch(
+            f"SELECT *{total} FROM pokemon WHERE user_id = $1 AND market_price IS NULL {constraints} {seek} "
+            f"ORDER BY {columns} LIMIT $2 OFFSET $3",
+            *args,
+        )
+
     def format_query(self, update, start=2):
+        # columns are sorted so the same set of columns always gives the same
+        # query text, and shares one statement in asyncpg's statement cache
+        columns = sorted(update)
         query = ", ".join(
             (f"{c[3:]} = any(${i}::int[])" if c.startswith("in_") else f"{c} = ${i}")
-            for i, c in enumerate(update, start)
+            for i, c in enumerate(columns, start)
         )
         args = []
-        for item in update:
+        for item in columns:
             args.append(update[item])
 
         return query, args
@@ -69,7 +353,7 @@ class Database(commands.Cog):
         builder = []
         args = []
         idx = start
-        for cs in update:
+        for cs in sorted(update):
             for c in update[cs]:
                 builder.append(
                     f"{cs[3:]} = any(${idx}::int[])"
@@ -84,42 +368,87 @@ class Database(commands.Cog):
     async def get_dex(self, id, *, connection=None):
         connection = connection or self.connection
         id = self.get_id_from_object(id)
-        entries = await connection.fetch("SELECT * FROM dex WHERE user_id = $1", id)
-        if not entries:
-            return {}
-        return {
-            entry["species_id"]: models.DexEntry(*(entry.values())) for entry in entries
-        }
+        if (dex := self.dexes.get(id)) is not MISSING:
+            return dex
+        version = self.dexes.version
+        entries = await connection.fetch(
+            "SELECT species_id, count FROM dex WHERE user_id = $1", id
+        )
+        dex = models.Dex({entry["species_id"]: entry["count"] for entry in entries})
+        self.dexes.set(id, dex, version)
+        return dex
 
     async def get_user(self, id, *, connection=None):
-        connection = connection or self.connection
         id = self.get_id_from_object(id)
-        user = await connection.fetchrow("SELECT * FROM users WHERE id = $1", id)
-        if not user:
-            return None
-        return models.User(*(user.values()))
+        if (user := self.caches["users"].get(id)) is not MISSING:
+            return user
+        version = self.caches["users"].version
+        user = await self.run("get_user", "fetchrow", id, connection=connection)
+        if user:
+            user = models.User(*(user.values()))
+        self.caches["users"].set(id, user, version)
+        return user
 
     async def get_guild(self, id, *, connection=None):
-        connection = connection or self.connection
         id = self.get_id_from_object(id)
-        guild = await connection.fetchrow("SELECT * FROM guilds WHERE id = $1", id)
-        if not guild:
-            return None
-        return models.Guild(*(guild.values()))
+        if (guild := self.caches["guilds"].get(id)) is not MISSING:
+            return guild
+        version = self.caches["guilds"].version
+        guild = await self.run("get_guild", "fetchrow", id, connection=connection)
+        if guild:
+            guild = models.Guild(*(guild.values()))
+        self.caches["guilds"].set(id, guild, version)
+        return guild
 
     async def get_channel(self, id, *, connection=None):
-        connection = connection or self.connection
         id = self.get_id_from_object(id)
-        channel = await connection.fetchrow("SELECT * FROM channels WHERE id = $1", id)
-        if not channel:
-            return None
-        return models.Channel(*(channel.values()))
+        if (channel := self.caches["channels"].get(id)) is not MISSING:
+            return channel
+        version = self.caches["channels"].version
+        channel = await self.run("get_channel", "fetchrow", id, connection=connection)
+        if channel:
+            channel = models.Channel(*(channel.values()))
+        self.caches["channels"].set(id, channel, version)
+        return channel
 
-    async def get_pokemon_by_idx(self, user_id, idx, *, connection=None):
+    async def get_rows(self, user, guild, channel, *, connection=None):
+        """Get the user, guild and channel rows, any not cached are fetched in one query"""
         connection = connection or self.connection
+        ids = {
+            "users": self.get_id_from_object(user),
+            "guilds": guild and self.get_id_from_object(guild),
+            "channels": channel and self.get_id_from_object(channel),
+        }
+        rows = {}
+        missing = []
+        for table, id in ids.items():
+            if id is None:
+                rows[table] = None
+            elif (row := self.caches[table].get(id)) is not MISSING:
+                rows[table] = row
+            else:
+                missing.append(table)
+
+        if missing:
+            versions = {table: self.caches[table].version for table in missing}
+            query = ", ".join(
+                f"(SELECT t FROM {table} t WHERE id = ${i}) AS {table}"
+                for i, table in enumerate(missing, 1)
+            )
+            record = await connection.fetchrow(
+                f"SELECT {query}", *(ids[table] for table in missing)
+            )
+            for table in missing:
+                row = record[table] and MODELS[table](*(record[table].values()))
+                self.caches[table].set(ids[table], row, versions[table])
+                rows[table] = row
+
+        return rows["users"], rows["guilds"], rows["channels"]
+
+    async def get_pokemon_by_idx(self, user_id, idx, *, connection=None):
         user_id = self.get_id_from_object(user_id)
-        return await connection.fetchrow(
-            "SELECT * FROM pokemon WHERE user_id = $1 AND idx = $2 AND market_price is NULL", user_id, idx
+        return await self.run(
+            "get_pokemon_by_idx", "fetchrow", user_id, idx, connection=connection
         )
 
     async def update_pokemon_by_idx(self, user_id, idx, update, *, connection=None):
@@ -130,50 +459,141 @@ class Database(commands.Cog):
             f"UPDATE pokemon SET {query} WHERE user_id = $1 AND idx = $2",
             *([user_id, idx] + args),
         )
+        self.forget_cursors(user_id)
 
-    async def update_selected_pokemon(self, user_id, update, *, connection=None):
+    async def save_pokemon(self, pokemon, *, connection=None):
+        """Write only the columns of the pokemon that have changed"""
+        if changes := pokemon.changes():
+            await self.update_pokemon_by_idx(
+                pokemon.user_id, pokemon.idx, changes, connection=connection
+            )
+            pokemon.dirty.clear()
+
+    async def add_pokemon_xp(self, gains, *, connection=None):
+        """Add xp to many pokemon, leveling up and evolving them as it overflows
+
+        `gains` holds a (user_id, idx, xp) tuple for each pokemon, the rows
+        as they are after the update are returned
+        """
+        user_ids, idxs, xps = zip(*gains)
+        records = await self.run(
+            "add_pokemon_xp",
+            "fetch",
+            list(user_ids),
+            list(idxs),
+            list(xps),
+            connection=connection,
+        )
+        self.forget_cursors(*set(user_ids))
+
+        rows = {(r["user_id"], r["idx"]): dict(r) for r in records}
+        evolutions = []
+        for row in rows.values():
+            if not row["ups"]:
+                continue
+            species = self.bot.data.get_species_by_id(row["species_id"])
+            while row["level"] >= species.get("evolution_level", 101):
+                species = self.bot.data.get_species_by_id(species["evolution"])
+            if species["species_id"] != row["species_id"]:
+                evolutions.append((row["user_id"], row["idx"], row["species_id"]))
+                row["species_id"] = species["species_id"]
+        if evolutions:
+            await self.run(
+                "evolve_pokemon",
+                "fetch",
+                [user_id for user_id, _, _ in evolutions],
+                [idx for _, idx, _ in evolutions],
+                [species_id for _, _, species_id in evolutions],
+                [rows[user_id, idx]["species_id"] for user_id, idx, _ in evolutions],
+                connection=connection,
+            )
+        return list(rows.values())
+
+    async def get_spawns(self, *, connection=None):
         connection = connection or self.connection
-        user_id = self.get_id_from_object(user_id)
-        selected = await connection.fetchval(
-            "SELECT selected FROM users WHERE id = $1", user_id
+        return await connection.fetch("SELECT * FROM spawns")
+
+    async def save_spawns(self, states, *, connection=None):
+        """Upsert the spawn state of many channels, given as channel id -> state"""
+        connection = connection or self.connection
+        await connection.execute(
+            "INSERT INTO spawns(channel_id, species_id, count, goal) "
+            "SELECT * FROM unnest($1::bigint[], $2::int[], $3::int[], $4::int[]) "
+            "ON CONFLICT(channel_id) DO UPDATE SET species_id = excluded.species_id, "
+            "count = excluded.count, goal = excluded.goal, updated = CURRENT_TIMESTAMP",
+            list(states),
+            [
+                state["pokemon"]["species_id"] if state["pokemon"] else None
+                for state in states.values()
+            ],
+            [state["count"] for state in states.values()],
+            [state["goal"] for state in states.values()],
         )
+
+    async def delete_stale_spawns(self, idle, *, connection=None):
+        connection = connection or self.connection
+        await connection.execute(
+            "DELETE FROM spawns WHERE species_id IS NULL AND updated < CURRENT_TIMESTAMP - make_interval(secs => $1)",
+            idle,
+        )
+
+    async def update_selected_pokemon(self, user_id, update, *, connection=None):
+        user = await self.get_user(user_id, connection=connection)
         await self.update_pokemon_by_idx(
-            user_id, selected, update, connection=connection
+            user_id, user.selected, update, connection=connection
         )
 
-    async def get_next_idx(self, user_id, *, connection=None):
+    async def get_latest_pokemon(self, user_id, offset=0, *, connection=None):
+        """Get a pokemon counted back from the last one the user has"""
         connection = connection or self.connection
         user_id = self.get_id_from_object(user_id)
-        return (
-            await connection.fetchval(
-                "SELECT idx+1 FROM pokemon WHERE user_id = $1 ORDER BY idx DESC LIMIT 1",
-                user_id,
-            )
-        ) or 1
+        # not next_idx - 1, which may have been released or never committed
+        return await connection.fetchrow(
+            "SELECT * FROM pokemon WHERE user_id = $1 AND market_price is NULL "
+            "ORDER BY idx DESC LIMIT 1 OFFSET $2",
+            user_id,
+            offset,
+        )
 
     async def insert_pokemon(self, user, species_id, *, shiny=False, connection=None):
         id = self.get_id_from_object(user)
-        connection = connection or self.connection
+        values = [id, species_id, *self.random_pokemon_values(shiny)]
+        record = await self.run(
+            "insert_pokemon", "fetchrow", *values, connection=connection
+        )
+        self.forget_cursors(id)
+        if not record:
+            return None
+        return models.Pokemon(record, self.bot.data)
 
-        query = f"INSERT INTO pokemon(user_id, idx, species_id, level, xp, nature, shiny, hp_iv, atk_iv, def_iv, spatk_iv, spdef_iv, spd_iv, moves) VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14) RETURNING *"
-        values = [
-            id,
-            await self.get_next_idx(id, connection=connection),
-            species_id,
-            random.randint(1, 25),
-            0,
-            random.choice(constants.NATURES),
-            shiny,
-            *self.random_ivs(),
-            ["Tackle"] * 4,
-        ]
-        return models.Pokemon(await connection.fetchrow(query, *values), self.bot.data)
+    async def catch_pokemon(self, user, species_id, *, shiny=False, connection=None):
+        """Insert a caught pokemon, bump the dex and pay out any reward in one statement
+
+        Returns the pokemon, the new dex count and the credits rewarded
+        """
+        id = self.get_id_from_object(user)
+        values = [id, species_id, *self.random_pokemon_values(shiny)]
+        record = await self.run(
+            "catch_pokemon", "fetchrow", *values, connection=connection
+        )
+        self.forget_cursors(id)
+        if not record:
+            return None, 0, 0
+        if (dex := self.dexes.get(id)) is not MISSING:
+            dex.caught(species_id, record["dex_count"])
+        # a dex read which started before this catch must not be cached
+        self.dexes.version += 1
+        return (
+            models.Pokemon(record, self.bot.data),
+            record["dex_count"],
+            record["credits"],
+        )
 
     async def register(self, id, *, connection=None):
         connection = connection or self.connection
         id = self.get_id_from_object(id)
         try:
-            await self.connection.execute(
+            await connection.execute(
                 "INSERT INTO users(id, selected, bal, redeem) VALUES ($1, $2, $3, $4)",
                 id,
                 1,
@@ -183,6 +603,7 @@ class Database(commands.Cog):
         except asyncpg.UniqueViolationError:
             return False
 
+        self.started.add(id)
         return True
 
 
@@ -1,4 +1,7 @@
 import time
+import bisect
+from array import array
+from collections import OrderedDict
 from discord.ui import View
 from discord.ext.menus.views import ViewMenuPages
 
@@ -49,3 +52,129 @@ class StopWatch:
     @property
     def time(self):
         return self.end - self.start
+
+
+class Cooldown:
+    """A per key cooldown that only remembers keys seen in the last two periods
+
+    Keys are written to the current bucket, which becomes the previous bucket
+    after a period, so anything older than two periods is dropped wholesale
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.current = {}
+        self.previous = {}
+        self.rotated = time.monotonic()
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def rotate(self, now):
+        if now - self.rotated < self.period:
+            return
+        self.previous = self.current if now - self.rotated < 2 * self.period else {}
+        self.current = {}
+        self.rotated = now
+
+    def is_on_cooldown(self, key):
+        """Check the key, starting its cooldown if it isn't on one"""
+        now = time.monotonic()
+        self.rotate(now)
+        last = self.current.get(key) or self.previous.get(key)
+        if last is not None and now - last <= self.period:
+            return True
+        self.current[key] = now
+        return False
+
+
+class ExpiringDefaultDict(OrderedDict):
+    """A defaultdict that keeps at most `maxsize` keys, evicting the least recently used"""
+
+    def __init__(self, default_factory, maxsize):
+        super().__init__()
+        self.default_factory = default_factory
+        self.maxsize = maxsize
+        self.accessed = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        self.accessed[key] = time.monotonic()
+        return value
+
+    def __missing__(self, key):
+        value = self[key] = self.default_factory()
+        while len(self) > self.maxsize:
+            del self[next(iter(self))]
+        return value
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.accessed.pop(key, None)
+
+    def prune(self, idle, keep=None):
+        """Remove keys not used in `idle` seconds, unless keep(value) is true"""
+        cutoff = time.monotonic() - idle
+        for key in list(self):
+            if self.accessed.get(key, 0) > cutoff:
+                # keys are in order of use so the rest are newer
+                break
+            if keep and keep(super().__getitem__(key)):
+                continue
+            del self[key]
+
+
+class IntSet:
+    """A compact set of ints, a sorted array plus small sets of recent changes
+
+    Membership is a bisect of the array, changes are folded into it once there
+    are enough of them
+    """
+
+    def __init__(self, values=(), compact_after=1024):
+        self.values = array("q", sorted(set(values)))
+        self.added = set()
+        self.removed = set()
+        self.compact_after = compact_after
+
+    def __len__(self):
+        return len(self.values) + len(self.added) - len(self.removed)
+
+    def __contains__(self, value):
+        if value in self.added:
+            return True
+        if value in self.removed:
+            return False
+        return self.in_values(value)
+
+    def in_values(self, value):
+        index = bisect.bisect_left(self.values, value)
+        return index < len(self.values) and self.values[index] == value
+
+    @property
+    def nbytes(self):
+        return self.values.itemsize * len(self.values)
+
+    def add(self, value):
+        if self.in_values(value):
+            self.removed.discard(value)
+        else:
+            self.added.add(value)
+        self.maybe_compact()
+
+    def discard(self, value):
+        if self.in_values(value):
+            self.removed.add(value)
+        else:
+            self.added.discard(value)
+        self.maybe_compact()
+
+    def maybe_compact(self):
+        if len(self.added) + len(self.removed) < self.compact_after:
+            return
+        values = set(self.values) - self.removed
+        values |= self.added
+        self.values = array("q", sorted(values))
+        self.added.clear()
+        self.removed.clear()
@@ -1,15 +1,45 @@
-import math
 from typing import List
 import datetime
 from dataclasses import dataclass
 
 
-@dataclass
-class DexEntry:
-    user_id: int
-    species_id: int
-    count: int
-    shinies: int
+class Dex:
+    """A user's catch counts by species id
+
+    Totals and orderings worked out from the counts are kept until the next catch
+    """
+
+    __slots__ = ("counts", "derived")
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def caught(self, species_id, count):
+        self.counts[species_id] = count
+        self.derived.clear()
+
+    def total(self, category, species):
+        """How many of `species`, the ids of a category, have been caught"""
+        key = ("total", category)
+        if (total := self.derived.get(key)) is None:
+            total = self.derived[key] = sum(1 for s in species if s in self.counts)
+        return total
+
+    def by_count(self, category, species, reverse=False):
+        """`species` with the uncaught by id first, then the caught by count"""
+        key = ("by_count", category, reverse)
+        if (order := self.derived.get(key)) is None:
+            counts = self.counts
+            order = self.derived[key] = sorted(
+                species,
+                key=lambda s: 60000 + counts[s] if s in counts else s,
+                reverse=reverse,
+            )
+        return order
 
 
 @dataclass
@@ -48,47 +78,65 @@ class User:
     total_votes: int
     # settings
     hide_levelup: bool
+    # pokemon
+    next_idx: int
+
+
+STATS = ("hp", "atk", "def", "spatk", "spdef", "spd")
+
+
+COLUMNS = (
+    "id",
+    "user_id",
+    "idx",
+    "timestamp",
+    "market_price",
+    "species_id",
+    "level",
+    "xp",
+    "nature",
+    "shiny",
+    "hp_iv",
+    "atk_iv",
+    "def_iv",
+    "spatk_iv",
+    "spdef_iv",
+    "spd_iv",
+    "total_iv",
+    "nick",
+    "moves",
+    "favorite",
+    "item",
+)
+COLUMN_SET = frozenset(COLUMNS)
 
 
-mapping = {
-    "atk": "attack",
-    "def": "defense",
-    "spdef": "special_defense",
-    "spatk": "special_attack",
-    "spd": "speed",
-}
+class Pokemon:
+    """A row of the pokemon table, changed columns are tracked in `dirty`"""
 
+    __slots__ = (*COLUMNS, "data_manager", "data", "dirty")
 
-class Pokemon:
     def __init__(self, record, data=None):
-        self.record = dict(record)
-        self.data_manager = data
+        set_attr = object.__setattr__
+        for column in COLUMNS:
+            set_attr(self, column, record.get(column))
+        set_attr(self, "data_manager", data)
+        set_attr(
+            self, "data", data.get_species_by_id(self.species_id) if data else None
+        )
+        set_attr(self, "dirty", set())
 
     def __setattr__(self, attr, obj):
-        if hasattr(self, attr):
-            self.record[attr] = obj
-        else:
-            super().__setattr__(attr, obj)
+        object.__setattr__(self, attr, obj)
+        if attr in COLUMN_SET:
+            self.dirty.add(attr)
+            if attr == "species_id" and self.data_manager:
+                object.__setattr__(
+                    self, "data", self.data_manager.get_species_by_id(obj)
+                )
 
-    @property
-    def id(self):
-        return self.record["id"]
-
-    @property
-    def idx(self):
-        return self.record["idx"]
-
-    @property
-    def species_id(self):
-        return self.record["species_id"]
-
-    @property
-    def nick(self):
-        return self.record["nick"]
-
-    @property
-    def favorite(self):
-        return self.record["favorite"]
+    def changes(self):
+        return {column: getattr(self, column) for column in self.dirty}
 
     @property
     def pretty_name(self):
@@ -104,10 +152,6 @@ class Pokemon:
 
         return name
 
-    @property
-    def data(self):
-        return self.data_manager.get_species_by_id(self.species_id)
-
     @property
     def name(self):
         if not self.data:
@@ -115,65 +159,29 @@ class Pokemon:
 
         return self.data["name"].title()
 
-    @property
-    def shiny(self):
-        return self.record["shiny"]
-
-    @property
-    def nature(self):
-        return self.record["nature"]
-
-    @property
-    def item(self):
-        return self.record["item"]
-
-    @property
-    def level(self):
-        return self.record["level"]
-
-    @property
-    def xp(self):
-        return self.record["xp"]
-
     @property
     def iv_percent(self):
-        return self.record["total_iv"] / 186
-
-    @property
-    def hp_iv(self):
-        return self.record["hp_iv"]
+        return self.total_iv / 186
 
     @property
-    def atk_iv(self):
-        return self.record["atk_iv"]
-
-    @property
-    def def_iv(self):
-        return self.record["def_iv"]
-
-    @property
-    def spatk_iv(self):
-        return self.record["spatk_iv"]
-
-    @property
-    def spdef_iv(self):
-        return self.record["spdef_iv"]
+    def xp_needed(self):
+        return 200 + 25 * self.level
 
     @property
-    def spd_iv(self):
-        return self.record["spd_iv"]
+    def ivs(self):
+        return (
+            self.hp_iv,
+            self.atk_iv,
+            self.def_iv,
+            self.spatk_iv,
+            self.spdef_iv,
+            self.spd_iv,
+        )
 
-    @property
-    def xp_needed(self):
-        return 200 + 25 * self.level
+    def stats(self):
+        return self.data_manager.species.compute_stats(
+            (self.species_id,), (self.level,), (self.ivs,)
+        )[0]
 
     def stat(self, stat):
-        iv = self.record[f"{stat}_iv"]
-        if stat == "hp":
-            return math.floor(
-                (2 * self.data["hp"] + self.hp_iv) * self.level / 100 + self.level + 10
-            )
-
-        return math.floor(
-            math.floor((2 * self.data[mapping[stat]] + iv) * self.level / 100 + 5)
-        )
+        return self.stats()[STATS.index(stat)]
@@ -0,0 +1,62 @@
+# hot queries, prepared on every pool connection as it is opened so they are
+# parsed and planned once per connection instead of whenever they fall out of
+# asyncpg's statement cache
+QUERIES = {
+    "get_user": "SELECT * FROM users WHERE id = $1",
+    "get_guild": "SELECT * FROM guilds WHERE id = $1",
+    "get_channel": "SELECT * FROM channels WHERE id = $1",
+    "get_pokemon_by_idx": (
+        "SELECT * FROM pokemon WHERE user_id = $1 AND idx = $2 AND market_price is NULL"
+    ),
+    # the idx is taken from the user's counter in the same statement so
+    # concurrent inserts for one user can never get the same idx
+    "insert_pokemon": (
+        "WITH counter AS (UPDATE users SET next_idx = next_idx + 1 WHERE id = $1 RETURNING next_idx - 1 AS idx) "
+        "INSERT INTO pokemon(user_id, idx, species_id, level, xp, nature, shiny, hp_iv, atk_iv, def_iv, spatk_iv, spdef_iv, spd_iv, moves) "
+        "SELECT $1, counter.idx, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13 FROM counter RETURNING *"
+    ),
+    # the dex upsert, reward and insert of a catch
+    "catch_pokemon": (
+        "WITH entry AS ("
+        "INSERT INTO dex(user_id, species_id, count) VALUES($1, $2, 1) "
+        "ON CONFLICT(user_id, species_id) DO UPDATE SET count = dex.count + 1 "
+        "RETURNING count, CASE WHEN count = 1 THEN 35 WHEN count IN (10, 100, 1000) THEN 35 * count ELSE 0 END AS credits"
+        "), counter AS ("
+        "UPDATE users SET next_idx = next_idx + 1, bal = bal + entry.credits FROM entry WHERE users.id = $1 "
+        "RETURNING users.next_idx - 1 AS idx, entry.count, entry.credits"
+        "), inserted AS ("
+        "INSERT INTO pokemon(user_id, idx, species_id, level, xp, nature, shiny, hp_iv, atk_iv, def_iv, spatk_iv, spdef_iv, spd_iv, moves) "
+        "SELECT $1, counter.idx, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13 FROM counter RETURNING *"
+        ") "
+        "SELECT inserted.*, counter.count AS dex_count, counter.credits FROM inserted, counter"
+    ),
+    # adds the xp gained to the row as it is now, so processes buffering xp for
+    # the same pokemon never overwrite each other, then levels it up. Leveling k
+    # times from level L takes k * (200 + 25L) + 25k(k - 1) / 2 xp
+    "add_pokemon_xp": (
+        "WITH gains AS ("
+        "SELECT * FROM unnest($1::bigint[], $2::int[], $3::int[]) AS g(user_id, idx, gain)"
+        "), locked AS ("
+        "SELECT pokemon.user_id, pokemon.idx, pokemon.level, pokemon.xp + gains.gain AS xp "
+        "FROM pokemon JOIN gains ON pokemon.user_id = gains.user_id AND pokemon.idx = gains.idx "
+        "FOR UPDATE OF pokemon"
+        "), leveled AS ("
+        "SELECT locked.user_id, locked.idx, ups.count AS ups, locked.level + ups.count AS level, "
+        "locked.xp - ups.count * (200 + 25 * locked.level) - 25 * ups.count * (ups.count - 1) / 2 AS xp "
+        "FROM locked, LATERAL ("
+        "SELECT COUNT(*)::int AS count FROM generate_series(1, 100 - locked.level) AS k "
+        "WHERE k * (200 + 25 * locked.level) + 25 * k * (k - 1) / 2 <= locked.xp"
+        ") AS ups"
+        ") "
+        "UPDATE pokemon SET level = leveled.level, xp = leveled.xp FROM leveled "
+        "WHERE pokemon.user_id = leveled.user_id AND pokemon.idx = leveled.idx "
+        "RETURNING pokemon.user_id, pokemon.idx, pokemon.species_id, pokemon.level, pokemon.xp, leveled.ups"
+    ),
+    # only evolves the pokemon if it is still the species it leveled up as
+    "evolve_pokemon": (
+        "UPDATE pokemon SET species_id = u.evolution "
+        "FROM unnest($1::bigint[], $2::int[], $3::int[], $4::int[]) "
+        "AS u(user_id, idx, species_id, evolution) "
+        "WHERE pokemon.user_id = u.user_id AND pokemon.idx = u.idx AND pokemon.species_id = u.species_id"
+    ),
+}
@@ -0,0 +1,10 @@
+-- Per user idx counter used by Database.insert_pokemon instead of scanning for MAX(idx)
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS next_idx INT NOT NULL DEFAULT 1;
+
+UPDATE users SET next_idx = p.idx + 1
+FROM (SELECT user_id, MAX(idx) AS idx FROM pokemon GROUP BY user_id) AS p
+WHERE users.id = p.user_id;
+
+COMMIT;
@@ -0,0 +1,5 @@
+-- Indexes for keyset pagination of the pokemon listing, one per ordering in helpers.database.ORDERINGS
+-- ordering by idx is served by the primary key
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pokemon_user_level ON pokemon(user_id, level, idx) WHERE market_price IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pokemon_user_total_iv ON pokemon(user_id, total_iv, idx) WHERE market_price IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pokemon_user_species_id ON pokemon(user_id, species_id, idx) WHERE market_price IS NULL;
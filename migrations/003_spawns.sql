@@ -0,0 +1,8 @@
+-- Snapshots of Spawning.spawns so spawn progress and wild pokemon survive restarts
+CREATE TABLE IF NOT EXISTS spawns(
+    channel_id BIGINT PRIMARY KEY,
+    species_id INT DEFAULT NULL,
+    count INT NOT NULL,
+    goal INT NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);